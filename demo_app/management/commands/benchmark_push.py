@@ -0,0 +1,219 @@
+import json
+import multiprocessing
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from firebase_push import codecs
+from firebase_push.engines.aio import AsyncSendEngine
+from firebase_push.engines.threaded import ThreadedSendEngine
+from firebase_push.message import PushMessage
+from firebase_push.models import FCMDeviceBase, FCMTopic
+from firebase_push.tasks import send_message
+from firebase_push.testing import FakeFCMServer
+from firebase_push.utils import get_device_model
+
+
+FCMDevice = get_device_model()
+User = get_user_model()
+
+
+class BenchmarkAsyncSendEngine(AsyncSendEngine):
+    def get_access_token(self) -> str:
+        return "benchmark"
+
+
+class BenchmarkThreadedSendEngine(ThreadedSendEngine):
+    def get_access_token(self) -> str:
+        return "benchmark"
+
+
+ENGINES = {
+    "async": "demo_app.management.commands.benchmark_push.BenchmarkAsyncSendEngine",
+    "threads": "demo_app.management.commands.benchmark_push.BenchmarkThreadedSendEngine",
+}
+
+
+class BenchmarkPushMessage(PushMessage):
+    """Push message that records the time spent in ``create_history_entries()``"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.history_time = 0.0
+
+    def create_history_entries(self, *args, **kwargs):
+        start = time.perf_counter()
+        entries = super().create_history_entries(*args, **kwargs)
+        self.history_time += time.perf_counter() - start
+        return entries
+
+
+class Rollback(Exception):
+    pass
+
+
+def run_server(urls: multiprocessing.Queue, stop: Any, **kwargs):
+    with FakeFCMServer(**kwargs) as server:
+        urls.put(server.url)
+        stop.wait()
+
+
+@contextmanager
+def server_process(**kwargs):
+    """Run the FCM stand-in in its own process, so it does not compete with the sender for the GIL"""
+    context = multiprocessing.get_context("fork")
+    urls = context.Queue()
+    stop = context.Event()
+    process = context.Process(target=run_server, args=(urls, stop), kwargs=kwargs, daemon=True)
+    process.start()
+    try:
+        yield urls.get(timeout=10)
+    finally:
+        stop.set()
+        process.join()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark fanout, render and sending of push messages against a local FCM stand-in. "
+        "Test data is created in the configured database and rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--devices",
+            "-n",
+            dest="devices",
+            nargs="+",
+            default=[1000, 10000, 100000],
+            type=int,
+            help="Number of devices to benchmark with, may be given multiple times",
+        )
+        parser.add_argument(
+            "--devices-per-user", dest="devices_per_user", default=2, type=int, help="Devices per seeded user"
+        )
+        parser.add_argument(
+            "--engine", dest="engine", default="threads", choices=ENGINES.keys(), help="Send engine to benchmark"
+        )
+        parser.add_argument(
+            "--latency", dest="latency", default=0.0, type=float, help="Latency of the FCM stand-in in seconds"
+        )
+        parser.add_argument(
+            "--error-rate",
+            dest="error_rate",
+            default=0.0,
+            type=float,
+            help="Probability of the FCM stand-in answering with an internal error",
+        )
+        parser.add_argument(
+            "--unregistered-rate",
+            dest="unregistered_rate",
+            default=0.0,
+            type=float,
+            help="Fraction of devices the FCM stand-in reports as unregistered",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stdout.write(f"{'devices':>8} {'stage':<24} {'seconds':>10} {'queries':>8} {'µs/device':>10}")
+        for count in options["devices"]:
+            try:
+                with transaction.atomic():
+                    self.benchmark(count)
+                    raise Rollback()
+            except Rollback:
+                pass
+
+    @contextmanager
+    def stage(self, name: str, count: int):
+        result: dict[str, Any] = {}
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            yield result
+            duration = result.get("duration", time.perf_counter() - start)
+        num_queries = result.get("queries", len(queries))
+        self.stdout.write(
+            f"{count:>8} {name:<24} {duration:>10.3f} {num_queries:>8} {duration / max(count, 1) * 1e6:>10.1f}"
+        )
+
+    def seed(self, count: int) -> list[str]:
+        devices_per_user = max(1, self.options["devices_per_user"])
+        topic = FCMTopic.objects.create(name=f"benchmark-{count}")
+        users = User.objects.bulk_create(
+            [User(username=f"benchmark-{count}-{i}") for i in range((count + devices_per_user - 1) // devices_per_user)]
+        )
+        platforms = [FCMDeviceBase.Platforms.ANDROID, FCMDeviceBase.Platforms.IOS, FCMDeviceBase.Platforms.WEB]
+        devices = FCMDevice.objects.bulk_create(
+            [
+                FCMDevice(
+                    registration_id=f"benchmark-{count}-{i}",
+                    user=users[i // devices_per_user],
+                    platform=platforms[i % len(platforms)],
+                )
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        if not all(device.pk for device in devices):
+            devices = FCMDevice.objects.filter(registration_id__startswith=f"benchmark-{count}-")
+        Subscription = FCMDevice.topics.through
+        Subscription.objects.bulk_create(
+            [Subscription(**{"fcmtopic": topic, FCMDevice._meta.model_name: device}) for device in devices],
+            batch_size=1000,
+        )
+        return [topic.name]
+
+    def benchmark(self, count: int):
+        with self.stage("seed", count):
+            topics = self.seed(count)
+
+        def make_message() -> BenchmarkPushMessage:
+            msg = BenchmarkPushMessage("Benchmark", "Benchmark message", link="https://example.com")
+            msg.topics = list(topics)
+            return msg
+
+        msg = make_message()
+        with self.stage("render()", count):
+            msg.render_cached()
+
+        msg = make_message()
+        with self.stage("fanout()", count):
+            for _ in msg.fanout_batches():
+                pass
+        with self.stage("create_history_entries()", count) as result:
+            result["duration"] = msg.history_time
+            result["queries"] = 0
+
+        # Task payload of a message addressed to all seeded users
+        msg = make_message()
+        msg.users = User.objects.filter(username__startswith=f"benchmark-{count}-")
+        data = msg.serialize()
+        with self.stage("json.dumps/loads", count):
+            PushMessage.from_json(json.dumps(data))
+        for name in codecs.CODECS:
+            try:
+                codecs.get_codec(name)
+            except ImproperlyConfigured:
+                continue
+            with self.stage(f"codec ({name})", count):
+                PushMessage.from_json(codecs.encode(data, name))
+
+        unregistered_count = int(count * self.options["unregistered_rate"])
+        unregistered = {f"benchmark-{count}-{i}" for i in range(unregistered_count)}
+        with server_process(
+            latency=self.options["latency"], error_rate=self.options["error_rate"], unregistered=unregistered
+        ) as url:
+            with override_settings(FCM_ENDPOINT_URL=url, FCM_SEND_ENGINE=ENGINES[self.options["engine"]]):
+                msg = make_message()
+                with self.stage(f"send_message ({self.options['engine']})", count):
+                    result = send_message(msg.to_json())
+
+        summary = defaultdict(int, result)
+        self.stdout.write(self.style.NOTICE(f"{count:>8} sent: {summary['sent']}, failed: {summary['failed']}"))
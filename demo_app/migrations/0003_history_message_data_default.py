@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("demo_app", "0002_history_user_nullable"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="fcmhistory",
+            name="message_data",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("demo_app", "0003_history_message_data_default"),
+        ("firebase_push", "0004_message_payload"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="fcmhistory",
+            index=models.Index(fields=["status", "updated_at"], name="demo_app_fc_status_4f71fd_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="fcmhistory",
+            index=models.Index(fields=["updated_at"], name="demo_app_fc_updated_b5c905_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="fcmhistory",
+            index=models.Index(fields=["message_id"], name="demo_app_fc_message_52cad1_idx"),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("demo_app", "0004_history_indexes"),
+        ("firebase_push", "0004_message_payload"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="fcmdevice",
+            index=models.Index(fields=["disabled_at", "updated_at"], name="demo_app_fc_disable_f298e5_idx"),
+        ),
+    ]
@@ -1 +1,850 @@
-# Create your tests here.
+import json
+from collections import Counter
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from firebase_admin.messaging import (
+    BatchResponse,
+    QuotaExceededError,
+    SendResponse,
+    TopicManagementResponse,
+    UnregisteredError,
+)
+
+from demo import celery_app
+from firebase_push import campaigns, codecs, device_cache, metrics, partitions, signals, topics
+from firebase_push.engines.batch import BatchSendEngine
+from firebase_push.engines.http import HTTPSendEngine
+from firebase_push.history import HistoryWriter
+from firebase_push.management.commands.age_devices import age_devices
+from firebase_push.management.commands.cleanup_devices import cleanup_devices
+from firebase_push.management.commands.cleanup_history import cleanup_history
+from firebase_push.management.commands.compact_history import compact_history
+from firebase_push.message import PushMessage
+from firebase_push.models import (
+    FCMCampaign,
+    FCMDeviceBase,
+    FCMHistoryBase,
+    FCMMessagePayload,
+    FCMMessageTargets,
+    FCMSubscriptionChange,
+    FCMTopic,
+)
+from firebase_push.serializers import FCMDeviceSerializer
+from firebase_push.serializers.devices import register_devices
+from firebase_push.tasks import (
+    dispatch_campaigns,
+    send_batch,
+    send_message,
+    sync_subscription_changes,
+    sync_topic_subscriptions,
+    write_history,
+)
+from firebase_push.testing import FakeFCMServer
+from firebase_push.utils import get_device_model, get_history_model
+
+
+FCMDevice = get_device_model()
+FCMHistory = get_history_model()
+User = get_user_model()
+
+
+class PushTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.default = FCMTopic.objects.get(name="default")
+        cls.news = FCMTopic.objects.create(name="news")
+        cls.users = []
+        for i in range(10):
+            user = User.objects.create(username=f"user-{i}")
+            cls.users.append(user)
+            for platform in (FCMDeviceBase.Platforms.IOS, FCMDeviceBase.Platforms.ANDROID):
+                device = FCMDevice.objects.create(registration_id=f"token-{platform}-{i}", user=user, platform=platform)
+                device.topics.add(cls.default, cls.news)
+
+    def make_message(self) -> PushMessage:
+        return PushMessage("Title", "Body")
+
+
+class FanoutTestCase(PushTestCase):
+    def test_fanout_users_query_count(self):
+        for count in (1, 10):
+            msg = self.make_message()
+            for user in self.users[:count]:
+                msg.add_user(user)
+            # topic lookup, device lookup, history insert
+            with self.assertNumQueries(3):
+                messages = msg.fanout()
+            self.assertEqual(len(messages), count * 2)
+            self.assertEqual(FCMHistory.objects.filter(message_id=msg.uuid).count(), count * 2)
+
+    def test_fanout_topics_query_count(self):
+        msg = self.make_message()
+        msg.add_topic("default")
+        msg.add_topic("news")
+        with self.assertNumQueries(3):
+            messages = msg.fanout()
+        self.assertEqual(len(messages), 40)
+
+        history = FCMHistory.objects.filter(message_id=msg.uuid)
+        self.assertEqual(history.filter(topic=self.news).count(), 20)
+        self.assertEqual(history.filter(topic=self.default).count(), 20)
+        self.assertFalse(history.exclude(status=FCMHistoryBase.Status.PENDING).exists())
+
+    def test_fanout_devices(self):
+        msg = self.make_message()
+        msg.add_device("token-ios-1")
+        msg.add_device("token-android-2")
+        FCMDevice.objects.filter(registration_id="token-android-2").update(disabled_at="2023-01-01T00:00:00Z")
+        with self.assertNumQueries(3):
+            messages = msg.fanout()
+        self.assertEqual([message.token for _, message in messages], ["token-ios-1"])
+        (history,) = messages[0][0]
+        self.assertEqual(history.user_id, self.users[1].pk)
+        self.assertEqual(history.topic, self.default)
+
+    @override_settings(FCM_DEVICE_CACHE_TIMEOUT=60)
+    def test_fanout_device_cache(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        signals.connect_device_cache()
+        self.addCleanup(signals.disconnect_device_cache)
+
+        for _ in range(2):
+            msg = self.make_message()
+            msg.add_user(self.users[0])
+            msg.add_user(self.users[1])
+            msg.fanout()
+            msg = self.make_message()
+            msg.add_topic("news")
+            msg.fanout()
+        msg = self.make_message()
+        msg.add_topic("news")
+        # topic lookup, history insert
+        with self.assertNumQueries(2):
+            self.assertEqual(len(msg.fanout()), 20)
+
+        device = FCMDevice.objects.get(registration_id="token-ios-1")
+        device.topics.remove(self.news)
+        msg = self.make_message()
+        msg.add_topic("news")
+        self.assertEqual(len(msg.fanout()), 19)
+
+        device.disabled_at = timezone.now()
+        device.save()
+        msg = self.make_message()
+        msg.add_user(self.users[1])
+        self.assertEqual([message.token for _, message in msg.fanout()], ["token-android-1"])
+
+    @override_settings(FCM_DEVICE_CACHE_TIMEOUT=60, FCM_DEVICE_CACHE_MAX_DEVICES=2, FCM_DEVICE_CACHE_MAX_USERS=1)
+    def test_device_cache_limits(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        # Devices of topics that are too large are not loaded, not even on the first miss
+        with self.assertNumQueries(1):
+            self.assertIsNone(device_cache.get_topic_devices({"news": self.news.pk}))
+        with self.assertNumQueries(0):
+            self.assertIsNone(device_cache.get_topic_devices({"news": self.news.pk}))
+        sport = FCMTopic.objects.create(name="sport")
+        FCMDevice.objects.get(registration_id="token-ios-0").topics.add(sport)
+        devices = device_cache.get_topic_devices({"sport": sport.pk})["sport"]
+        self.assertEqual([device.registration_id for device in devices], ["token-ios-0"])
+
+        # Messages to more users are resolved from the database
+        msg = self.make_message()
+        msg.add_user(self.users[0])
+        msg.add_user(self.users[1])
+        with mock.patch("firebase_push.device_cache.get_user_devices") as get_user_devices:
+            self.assertEqual(len(msg.fanout()), 4)
+            msg.send(at=timezone.now() + timedelta(hours=1))
+        self.assertFalse(get_user_devices.called)
+
+    @override_settings(FCM_TOPIC_CACHE_TIMEOUT=60)
+    def test_topic_registry(self):
+        cache.clear()
+        topics.registry.clear()
+        self.addCleanup(topics.registry.clear)
+        signals.connect_topic_registry()
+        self.addCleanup(signals.disconnect_topic_registry)
+
+        self.make_message().fanout()
+        msg = self.make_message()
+        msg.add_user(self.users[0])
+        # device lookup, history insert
+        with self.assertNumQueries(2):
+            msg.fanout()
+
+        # Created topics are not remembered as missing: lookup, insert, lookup of created
+        with self.assertNumQueries(3):
+            self.assertEqual(set(topics.ensure_topics(["news", "sports"])), {"news", "sports"})
+        with self.assertNumQueries(0):
+            self.assertEqual(topics.ensure_topics(["sports"])["sports"].name, "sports")
+
+        self.news.name = "headlines"
+        self.news.save()
+        self.assertEqual(set(topics.get_topics(["news", "headlines"])), {"headlines"})
+
+    def test_fanout_batches(self):
+        msg = self.make_message()
+        msg.add_topic("default")
+        msg.add_topic("news")
+        batches = msg.fanout_batches(batch_size=15)
+        first = next(batches)
+        self.assertEqual(len(first), 15)
+        self.assertEqual(FCMHistory.objects.filter(message_id=msg.uuid).count(), 15)
+        self.assertEqual([len(batch) for batch in batches], [15, 10])
+        self.assertEqual(FCMHistory.objects.filter(message_id=msg.uuid).count(), 40)
+
+    def test_fanout_message_data(self):
+        msg = self.make_message()
+        msg.add_topic("news")
+        with mock.patch.object(msg, "render", wraps=msg.render) as render:
+            messages = msg.fanout()
+        render.assert_called_once()
+        for (history,), message in messages:
+            self.assertEqual(history.message_data, json.loads(str(message)))
+
+    @override_settings(FCM_COMPACT_HISTORY=True)
+    def test_fanout_compact_history(self):
+        msg = self.make_message()
+        msg.add_topic("news")
+        messages = msg.fanout()
+        payload = FCMMessagePayload.objects.get(message_id=msg.uuid)
+        self.assertNotIn("token", payload.data)
+        for (history,), message in messages:
+            self.assertEqual(history.message_data, {"token": message.token})
+            self.assertEqual(history.payload, json.loads(str(message)))
+
+    def test_compact_history_command(self):
+        msg = self.make_message()
+        msg.add_topic("news")
+        messages = msg.fanout()
+        FCMHistory.objects.filter(pk=messages[-1][0][0].pk).update(message_data={"token": "token-ios-9", "extra": 1})
+
+        self.assertEqual(compact_history(batch_size=8), (1, 19))
+        for (history,), message in messages[:-1]:
+            history.refresh_from_db()
+            self.assertEqual(history.message_data, {"token": message.token})
+            self.assertEqual(history.payload, json.loads(str(message)))
+        self.assertEqual(compact_history(), (0, 0))
+
+
+class HistoryPartitionsTestCase(TestCase):
+    def test_add_months(self):
+        self.assertEqual(partitions.add_months(date(2023, 11, 1), 1), date(2023, 12, 1))
+        self.assertEqual(partitions.add_months(date(2023, 12, 1), 1), date(2024, 1, 1))
+        self.assertEqual(partitions.add_months(date(2024, 1, 1), -13), date(2022, 12, 1))
+
+    def test_not_partitioned(self):
+        self.assertFalse(partitions.is_partitioned(FCMHistory))
+        with self.assertRaises(CommandError):
+            call_command("history_partitions")
+
+
+class CleanupTestCase(PushTestCase):
+    def test_cleanup_history(self):
+        msg = self.make_message()
+        msg.add_topic("news")
+        msg.fanout()
+        history = FCMHistory.objects.filter(message_id=msg.uuid).order_by("pk")
+        FCMHistory.objects.filter(pk__in=list(history.values_list("pk", flat=True)[:5])).update(
+            status=FCMHistoryBase.Status.SENT
+        )
+        history.update(updated_at=timezone.now() - timedelta(days=10))
+        FCMMessagePayload.objects.create(message_id=msg.uuid, data={})
+        FCMMessagePayload.objects.update(created_at=timezone.now() - timedelta(days=10))
+        # History of a recent message may not have been written yet
+        recent = FCMMessagePayload.objects.create(message_id=uuid4(), data={})
+
+        # Targets of campaigns that have not finished are kept
+        campaign_msg = self.make_message()
+        for user in self.users:
+            campaign_msg.add_user(user)
+        with override_settings(FCM_MAX_INLINE_TARGETS=5):
+            campaign = campaign_msg.send(at=timezone.now() + timedelta(days=1))
+            done_msg = self.make_message()
+            for user in self.users:
+                done_msg.add_user(user)
+            done = done_msg.send(at=timezone.now())
+        FCMCampaign.objects.filter(pk=done.pk).update(status=FCMCampaign.Status.DONE)
+        FCMMessageTargets.objects.update(created_at=timezone.now() - timedelta(days=10))
+
+        # 3 batches of selecting and deleting, payload and targets cleanup
+        with self.assertNumQueries(3 * 2 + 1 + 2):
+            self.assertEqual(cleanup_history(days=5, batch_size=8), (15, 5, 0))
+        self.assertFalse(history.exists())
+        self.assertEqual(list(FCMMessagePayload.objects.all()), [recent])
+        campaign.refresh_from_db()
+        self.assertEqual(FCMMessageTargets.objects.get().message_id, campaign.message_id)
+
+    def test_cleanup_devices(self):
+        FCMDevice.objects.filter(platform=FCMDeviceBase.Platforms.ANDROID).update(
+            disabled_at=timezone.now() - timedelta(days=10)
+        )
+        self.assertEqual(cleanup_devices(days=5, batch_size=3), 10)
+        self.assertEqual(FCMDevice.objects.count(), 10)
+        self.assertEqual(cleanup_devices(days=5), 0)
+
+    def test_age_devices(self):
+        FCMDevice.objects.filter(platform=FCMDeviceBase.Platforms.ANDROID).update(
+            updated_at=timezone.now() - timedelta(days=10)
+        )
+        disabled = FCMDevice.objects.filter(registration_id="token-android-0")
+        disabled.update(disabled_at=timezone.now() - timedelta(days=3))
+        self.assertEqual(age_devices(days=5, batch_size=4), 9)
+        self.assertEqual(FCMDevice.objects.filter(disabled_at__isnull=False).count(), 10)
+        self.assertLess(disabled.get().disabled_at, timezone.now() - timedelta(days=2))
+        self.assertEqual(age_devices(days=5), 0)
+
+
+class DeviceSerializerTestCase(PushTestCase):
+    def register(self, user, data, instance=None, partial=False):
+        context = {"request": SimpleNamespace(user=user)}
+        serializer = FCMDeviceSerializer(instance, data=data, context=context, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return serializer.data
+
+    def test_register_query_count(self):
+        data = {"registration_id": "token-web-new", "topics": ["default", "news"], "platform": "web"}
+        # topic lookup, device lookup, upsert, topic insert
+        with self.assertNumQueries(4):
+            result = self.register(self.users[0], data)
+        self.assertEqual(result["topics"], ["default", "news"])
+        device = FCMDevice.objects.get(registration_id="token-web-new")
+        self.assertEqual((device.user, device.platform), (self.users[0], FCMDeviceBase.Platforms.WEB))
+
+        # Registering again with the same topics
+        FCMDevice.objects.filter(pk=device.pk).update(disabled_at=timezone.now())
+        with self.assertNumQueries(4):
+            self.register(self.users[0], {"registration_id": "token-web-new", "topics": ["news", "default"]})
+        device.refresh_from_db()
+        self.assertIsNone(device.disabled_at)
+        self.assertEqual(device.platform, FCMDeviceBase.Platforms.WEB)
+
+    def test_register_topic_changes(self):
+        device = FCMDevice.objects.get(registration_id="token-ios-0")
+        sport = FCMTopic.objects.create(name="sport")
+        with override_settings(FCM_SERVER_SIDE_TOPICS=True):
+            result = self.register(self.users[0], {"topics": ["news", "sport"]}, instance=device, partial=True)
+        self.assertEqual(result["topics"], ["news", "sport"])
+        self.assertEqual(set(device.topics.all()), {self.news, sport})
+        changes = FCMSubscriptionChange.objects.order_by("action").values_list("topic", "action")
+        self.assertEqual(
+            list(changes),
+            [
+                (sport.pk, FCMSubscriptionChange.Action.SUBSCRIBE),
+                (self.default.pk, FCMSubscriptionChange.Action.UNSUBSCRIBE),
+            ],
+        )
+
+    def test_register_other_user(self):
+        msg = self.make_message()
+        msg.add_device("token-ios-0")
+        msg.fanout()
+        self.register(self.users[1], {"registration_id": "token-ios-0", "topics": ["news"]})
+        device = FCMDevice.objects.get(registration_id="token-ios-0")
+        self.assertEqual(device.user, self.users[1])
+        self.assertEqual(device.platform, FCMDeviceBase.Platforms.UNKNOWN)
+        self.assertEqual(list(device.topics.all()), [self.news])
+        self.assertFalse(FCMHistory.objects.filter(device=device).exists())
+
+    @override_settings(FCM_REGISTRATION_FRESHNESS=3600)
+    def test_register_heartbeat(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        data = {"registration_id": "token-web-new", "topics": ["default"], "platform": "web"}
+        first = self.register(self.users[0], data)
+        device = FCMDevice.objects.get(registration_id="token-web-new")
+
+        # topic lookup, device check
+        with self.assertNumQueries(2):
+            self.assertEqual(self.register(self.users[0], data), first)
+
+        # Changed data is written
+        with self.assertNumQueries(4):
+            self.register(self.users[0], dict(data, app_version="2.0"))
+        self.assertEqual(FCMDevice.objects.get(pk=device.pk).app_version, "2.0")
+
+    @override_settings(FCM_REGISTRATION_FRESHNESS=3600)
+    def test_register_heartbeat_changed_device(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        data = {"registration_id": "token-web-new", "topics": ["default"], "platform": "web"}
+        self.register(self.users[0], data)
+
+        FCMDevice.objects.filter(registration_id="token-web-new").delete()
+        self.register(self.users[0], data)
+        self.assertTrue(FCMDevice.objects.filter(registration_id="token-web-new").exists())
+
+        FCMDevice.objects.filter(registration_id="token-web-new").update(disabled_at=timezone.now())
+        self.register(self.users[0], data)
+        self.assertIsNone(FCMDevice.objects.get(registration_id="token-web-new").disabled_at)
+
+        # Taken over by another user and registered by the first user again
+        self.register(self.users[1], data)
+        self.register(self.users[0], data)
+        self.assertEqual(FCMDevice.objects.get(registration_id="token-web-new").user, self.users[0])
+
+    def test_register_unknown_topic(self):
+        context = {"request": SimpleNamespace(user=self.users[0])}
+        serializer = FCMDeviceSerializer(data={"registration_id": "token-web-new", "topics": ["nope"]}, context=context)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("topics", serializer.errors)
+
+
+class BulkRegistrationTestCase(PushTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(username="admin", is_superuser=True))
+
+    def test_bulk_register(self):
+        FCMTopic.objects.create(name="sport")
+        items = [{"registration_id": f"token-bulk-{i}", "topics": ["news", "sport"]} for i in range(20)]
+        items.append({"registration_id": "token-ios-0", "topics": ["default"], "platform": "ios"})
+        items.append({"registration_id": "token-bad-0", "topics": ["unknown"]})
+        items.append({"registration_id": "token-bulk-0", "topics": []})
+        items.append({"registration_id": "token-bad-1"})
+
+        # session, user, topics, devices, history detach, upsert, current topics, topic delete, topic insert
+        with self.assertNumQueries(9):
+            response = self.client.post("/firebase-push/bulk/", items, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual([result.get("status") for result in results], ["created"] * 20 + ["updated"] + [None] * 3)
+        self.assertEqual(results[0]["device"]["topics"], ["news", "sport"])
+        self.assertEqual(results[20]["device"]["topics"], ["default"])
+        self.assertIn("topics", results[21]["errors"])
+        self.assertIn("registration_id", results[22]["errors"])
+        self.assertIn("topics", results[23]["errors"])
+
+        self.assertEqual(FCMDevice.objects.filter(registration_id__startswith="token-bulk-").count(), 20)
+        self.assertEqual(list(FCMDevice.objects.get(registration_id="token-ios-0").topics.all()), [self.default])
+        self.assertEqual(FCMDevice.objects.get(registration_id="token-ios-0").user.username, "admin")
+
+    def test_bulk_limit(self):
+        with override_settings(FCM_BULK_REGISTRATION_LIMIT=2):
+            response = self.client.post("/firebase-push/bulk/", [{}] * 3, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class HistoryWriterTestCase(PushTestCase):
+    def test_flush_size(self):
+        msg = self.make_message()
+        msg.add_topic("news")
+        entries = [history for history_items, _ in msg.fanout() for history in history_items]
+
+        writer = HistoryWriter(flush_size=8)
+        with self.assertNumQueries(2):
+            for entry in entries:
+                entry.status = FCMHistoryBase.Status.SENT
+                writer.add([entry])
+        self.assertEqual(len(writer.pending), 4)
+        with self.assertNumQueries(1):
+            writer.flush()
+        self.assertEqual(FCMHistory.objects.filter(message_id=msg.uuid, status=FCMHistoryBase.Status.SENT).count(), 20)
+
+
+def fake_send_each(messages, app=None):
+    responses = []
+    for i, message in enumerate(messages):
+        if message.token and message.token.startswith("token-android"):
+            responses.append(SendResponse(None, UnregisteredError("Requested entity was not found.")))
+        else:
+            responses.append(SendResponse({"name": f"projects/demo/messages/{i}"}, None))
+    return BatchResponse(responses)
+
+
+def fake_topic_management(tokens, topic, app=None):
+    return TopicManagementResponse({"results": [{"error": "INVALID_ARGUMENT"} if "-9" in t else {} for t in tokens]})
+
+
+@mock.patch("firebase_admin.messaging.send_each", side_effect=fake_send_each)
+class SendMessageTestCase(PushTestCase):
+    def setUp(self):
+        always_eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", always_eager)
+
+    def send(self, msg: PushMessage):
+        return send_message.apply(args=(json.dumps(msg.serialize()),)).get()
+
+    def assertSent(self, msg: PushMessage):
+        history = FCMHistory.objects.filter(message_id=msg.uuid)
+        self.assertEqual(history.filter(status=FCMHistoryBase.Status.SENT).count(), 10)
+        self.assertEqual(history.filter(status=FCMHistoryBase.Status.FAILED, device=None).count(), 10)
+        self.assertFalse(FCMDevice.objects.filter(platform=FCMDeviceBase.Platforms.ANDROID).exists())
+
+    def test_send_batch(self, send_each):
+        msg = self.make_message()
+        msg.add_user(self.users[0])
+        msg.add_user(self.users[1])
+        responses = {
+            "token-ios-0": SendResponse({"name": "projects/demo/messages/0"}, None),
+            "token-ios-1": SendResponse(None, QuotaExceededError("Quota exceeded")),
+            "token-android-0": SendResponse(None, UnregisteredError("Requested entity was not found.")),
+            "token-android-1": SendResponse({"name": "projects/demo/messages/1"}, None),
+        }
+        send_each.side_effect = lambda messages, app=None: BatchResponse([responses[m.token] for m in messages])
+        with HistoryWriter() as writer:
+            summary = send_batch(msg.fanout(), BatchSendEngine(None), writer)
+        self.assertEqual(summary, {"sent": 2, "failed": 2})
+        self.assertEqual(send_each.call_count, 1)
+
+        # Each response is recorded in the history entry of its device
+        history = FCMHistory.objects.filter(message_id=msg.uuid)
+        sent = history.filter(status=FCMHistoryBase.Status.SENT)
+        self.assertEqual(
+            set(sent.values_list("device__registration_id", "error_message")),
+            {("token-ios-0", "projects/demo/messages/0"), ("token-android-1", "projects/demo/messages/1")},
+        )
+        failed = history.get(status=FCMHistoryBase.Status.FAILED, device__registration_id="token-ios-1")
+        self.assertIn("Quota exceeded", failed.error_message)
+
+        # Unregistered tokens are removed, their history is kept
+        self.assertTrue(history.filter(status=FCMHistoryBase.Status.FAILED, device=None).exists())
+        self.assertFalse(FCMDevice.objects.filter(registration_id="token-android-0").exists())
+
+    @override_settings(FCM_SEND_BATCH_SIZE=3)
+    def test_send_batches(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("news")
+        self.assertEqual(self.send(msg), {"sent": 10, "failed": 10})
+        self.assertEqual(send_each.call_count, 7)
+        self.assertSent(msg)
+
+    def test_task_codecs(self, send_each):
+        msg = self.make_message()
+        msg.users = User.objects.filter(pk__in=[user.pk for user in self.users[:3]])
+        msg.expiration = datetime(2030, 1, 1, 12, 30)
+        for name in codecs.CODECS:
+            try:
+                codecs.get_codec(name)
+            except ImproperlyConfigured:
+                # orjson and msgpack are optional
+                continue
+            with override_settings(FCM_TASK_CODEC=name):
+                serialized = msg.to_json()
+            self.assertTrue(serialized.startswith(f"fcm:1:{name}:"))
+            decoded = PushMessage.from_json(serialized)
+            self.assertEqual(decoded.serialize(), msg.serialize())
+            self.assertEqual(decoded.expiration, msg.expiration)
+
+        # Payloads queued before codecs were tagged
+        self.assertEqual(PushMessage.from_json(json.dumps(msg.serialize())).uuid, msg.uuid)
+
+    def test_send_aware_expiration(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("news")
+        msg.expiration = timezone.now() + timedelta(hours=1)
+        decoded = PushMessage.from_json(msg.to_json())
+        self.assertEqual(decoded.expiration, msg.expiration)
+        self.assertEqual(self.send(decoded), {"sent": 10, "failed": 10})
+        ttl = send_each.call_args.args[0][0].android.ttl
+        self.assertTrue(timedelta(minutes=59) < ttl <= timedelta(hours=1))
+
+    @override_settings(FCM_MAX_INLINE_TARGETS=5)
+    def test_send_targets_by_reference(self, send_each):
+        msg = self.make_message()
+        for user in self.users:
+            msg.add_user(user)
+        serialized = msg.to_json()
+        self.assertEqual(codecs.decode(serialized)["_users"], [])
+        self.assertTrue(FCMMessageTargets.objects.filter(message_id=msg.uuid).exists())
+        self.assertEqual(PushMessage.from_json(serialized).users.count(), 10)
+
+        self.assertEqual(send_message.apply(args=(serialized,)).get(), {"sent": 10, "failed": 10})
+        self.assertSent(msg)
+
+    def test_get_shards(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("news")
+        devices = list(FCMDevice.objects.order_by("pk").values_list("pk", flat=True))
+        shards = msg.get_shards(6)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards[0][0], devices[0])
+        self.assertEqual(shards[-1][1], devices[-1])
+        for (_, last_pk), (first_pk, _) in zip(shards, shards[1:]):
+            self.assertEqual(last_pk + 1, first_pk)
+
+    def test_metrics(self, send_each):
+        class RecordingBackend(metrics.MetricsBackend):
+            def __init__(self):
+                self.timings = Counter()
+                self.counters = Counter()
+
+            def timing(self, name, seconds, tags=None):
+                self.timings[name] += 1
+
+            def increment(self, name, value=1, tags=None):
+                self.counters[(name, tags["topic"], tags["platform"])] += value
+
+        backend = RecordingBackend()
+        metrics.set_backend(backend)
+        self.addCleanup(metrics.set_backend, None)
+
+        msg = self.make_message()
+        msg.add_topic("news")
+        self.send(msg)
+        self.assertEqual(backend.timings, {"render": 1, "fanout": 1, "send": 1, "history_flush": 1})
+        self.assertEqual(
+            backend.counters,
+            {
+                ("sent", "news", FCMDeviceBase.Platforms.IOS): 10,
+                ("failed", "news", FCMDeviceBase.Platforms.ANDROID): 10,
+                ("unregistered", "news", FCMDeviceBase.Platforms.ANDROID): 10,
+            },
+        )
+
+    @override_settings(FCM_SHARD_SIZE=6)
+    def test_send_shards(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("news")
+        self.send(msg)
+        self.assertEqual(send_each.call_count, 4)
+        self.assertSent(msg)
+
+    @override_settings(FCM_HISTORY_WRITE_BEHIND=True, FCM_HISTORY_FLUSH_SIZE=8)
+    def test_send_write_behind(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("news")
+        # The json serializer keeps milliseconds
+        sent_at = (timezone.now() - timedelta(minutes=5)).replace(microsecond=0)
+        with mock.patch("firebase_push.tasks.write_history.apply_async", wraps=write_history.apply_async) as task:
+            with mock.patch("firebase_push.history.timezone.now", return_value=sent_at):
+                self.assertEqual(self.send(msg), {"sent": 10, "failed": 10})
+        self.assertEqual(task.call_count, 3)
+        self.assertSent(msg)
+        # Entries keep the time of sending instead of the time the task wrote them
+        history = FCMHistory.objects.filter(message_id=msg.uuid)
+        self.assertEqual(history.filter(created_at=sent_at, updated_at=sent_at).count(), 20)
+        self.assertEqual(history.exclude(device=None).count(), 10)
+
+    @override_settings(FCM_SERVER_SIDE_TOPICS=True)
+    def test_send_server_side_topics(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("default")
+        msg.add_topic("news")
+        self.assertEqual(self.send(msg), {"sent": 2, "failed": 0})
+        (messages,), _ = send_each.call_args
+        self.assertEqual([message.topic for message in messages], ["default", "news"])
+
+        history = FCMHistory.objects.filter(message_id=msg.uuid)
+        self.assertEqual(history.count(), 2)
+        self.assertEqual(history.filter(status=FCMHistoryBase.Status.SENT, user=None, device=None).count(), 2)
+        self.assertEqual(history.get(topic=self.news).message_data["topic"], "news")
+
+        # Messages addressed to users are still sent per device
+        msg = self.make_message()
+        msg.add_user(self.users[0])
+        self.assertEqual(self.send(msg), {"sent": 1, "failed": 1})
+
+    @mock.patch("firebase_admin.messaging.unsubscribe_from_topic", side_effect=fake_topic_management)
+    @mock.patch("firebase_admin.messaging.subscribe_to_topic", side_effect=fake_topic_management)
+    def test_sync_topic_subscriptions(self, subscribe_to_topic, unsubscribe_from_topic, send_each):
+        FCMDevice.objects.filter(registration_id="token-ios-0").update(disabled_at="2023-01-01T00:00:00Z")
+        with mock.patch("firebase_push.subscriptions.FCM_MAX_SUBSCRIPTION_BATCH_SIZE", 8):
+            result = sync_topic_subscriptions.apply(kwargs={"topic": "news"}).get()
+        self.assertEqual(result, {"subscribed": 17, "unsubscribed": 1, "failed": 2})
+        self.assertEqual([len(call.args[0]) for call in subscribe_to_topic.call_args_list], [8, 8, 3])
+        self.assertEqual(unsubscribe_from_topic.call_args.args, (["token-ios-0"], "news"))
+
+
+@mock.patch("firebase_admin.messaging.send_each", side_effect=fake_send_each)
+class CampaignTestCase(PushTestCase):
+    def setUp(self):
+        always_eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", always_eager)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def dispatch(self, now: float) -> int:
+        with mock.patch("firebase_push.ratelimit.time.time", return_value=now):
+            with self.captureOnCommitCallbacks(execute=True):
+                return dispatch_campaigns()
+
+    def test_rate_limited_campaign(self, send_each):
+        msg = self.make_message()
+        msg.add_topic("news")
+        campaign = msg.send(rate=6)
+        self.assertFalse(send_each.called)
+
+        # Shards of 6 devices, one shard per minute
+        self.assertEqual(self.dispatch(0), 1)
+        self.assertEqual(self.dispatch(30), 0)
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, FCMCampaign.Status.SENDING)
+        self.assertEqual((len(campaign.shards), campaign.finished_shards, campaign.devices), (4, 1, 20))
+
+        self.assertTrue(campaigns.pause(campaign))
+        self.assertEqual(self.dispatch(60), 0)
+        campaign.refresh_from_db()
+        self.assertTrue(campaigns.resume(campaign))
+        for minute in (2, 3, 4):
+            self.assertEqual(self.dispatch(minute * 60), 1)
+
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, FCMCampaign.Status.DONE)
+        self.assertEqual((campaign.finished_shards, campaign.sent, campaign.failed), (4, 10, 10))
+        self.assertEqual(self.dispatch(300), 0)
+
+    def test_exact_shards(self, send_each):
+        # Primary keys with a large gap, shards follow the devices and not the keys
+        last = FCMDevice.objects.order_by("pk").last()
+        device = FCMDevice.objects.create(
+            pk=last.pk + 1000, registration_id="token-ios-gap", user=self.users[0], platform="ios"
+        )
+        device.topics.add(self.news)
+        msg = self.make_message()
+        msg.add_topic("news")
+        shards = msg.get_exact_shards(6)
+        self.assertEqual([count for _first, _last, count in shards], [6, 6, 6, 3])
+        self.assertEqual(shards[-1][1], device.pk)
+
+        # Devices addressed by multiple topics are not split between shards
+        msg.add_topic("default")
+        shards = msg.get_exact_shards(5)
+        self.assertEqual(sum(count for _first, _last, count in shards), 41)
+        self.assertTrue(all(count <= 5 for _first, _last, count in shards))
+        self.assertEqual([count for _first, _last, count in msg.get_exact_shards(1)][:2], [2, 2])
+
+    def test_scheduled_campaign(self, send_each):
+        msg = self.make_message()
+        msg.add_user(self.users[0])
+        campaign = msg.send(at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.dispatch(0), 0)
+
+        FCMCampaign.objects.filter(pk=campaign.pk).update(send_at=timezone.now())
+        self.assertEqual(self.dispatch(0), 1)
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, FCMCampaign.Status.DONE)
+        self.assertEqual((campaign.sent, campaign.failed), (1, 1))
+
+
+@mock.patch("firebase_admin.messaging.unsubscribe_from_topic", side_effect=fake_topic_management)
+@mock.patch("firebase_admin.messaging.subscribe_to_topic", side_effect=fake_topic_management)
+class SubscriptionChangesTestCase(PushTestCase):
+    def setUp(self):
+        signals.connect()
+        self.addCleanup(signals.disconnect)
+
+    def test_record_changes(self, subscribe_to_topic, unsubscribe_from_topic):
+        device = FCMDevice.objects.get(registration_id="token-ios-0")
+        device.topics.remove(self.news)
+        device.topics.add(self.news)
+        self.news.devices.remove(FCMDevice.objects.get(registration_id="token-ios-1"))
+        FCMDevice.objects.get(registration_id="token-android-0").delete()
+        changes = FCMSubscriptionChange.objects.order_by("pk").values_list("registration_id", "topic", "action")
+        self.assertEqual(
+            list(changes),
+            [
+                ("token-ios-0", self.news.pk, FCMSubscriptionChange.Action.UNSUBSCRIBE),
+                ("token-ios-0", self.news.pk, FCMSubscriptionChange.Action.SUBSCRIBE),
+                ("token-ios-1", self.news.pk, FCMSubscriptionChange.Action.UNSUBSCRIBE),
+                ("token-android-0", self.default.pk, FCMSubscriptionChange.Action.UNSUBSCRIBE),
+                ("token-android-0", self.news.pk, FCMSubscriptionChange.Action.UNSUBSCRIBE),
+            ],
+        )
+
+        self.assertEqual(sync_subscription_changes(), {"subscribed": 1, "unsubscribed": 3, "failed": 0})
+        self.assertEqual(subscribe_to_topic.call_args.args, (["token-ios-0"], "news"))
+        self.assertEqual(unsubscribe_from_topic.call_count, 2)
+        self.assertFalse(FCMSubscriptionChange.objects.exists())
+
+    @override_settings(FCM_SERVER_SIDE_TOPICS=True)
+    def test_disabled_devices(self, subscribe_to_topic, unsubscribe_from_topic):
+        FCMDevice.objects.filter(registration_id__in=["token-ios-0", "token-ios-1"]).update(
+            updated_at=timezone.now() - timedelta(days=10)
+        )
+        self.assertEqual(age_devices(days=5), 2)
+        changes = FCMSubscriptionChange.objects.values_list("registration_id", "topic", "action")
+        self.assertEqual(
+            set(changes),
+            {
+                (f"token-ios-{i}", topic.pk, FCMSubscriptionChange.Action.UNSUBSCRIBE)
+                for i in (0, 1)
+                for topic in (self.default, self.news)
+            },
+        )
+        FCMSubscriptionChange.objects.all().delete()
+
+        # Re-enabled devices are subscribed to all their topics, with and without changing them
+        register_devices(self.users[0].pk, [("token-ios-0", {"platform": "ios"})])
+        register_devices(self.users[1].pk, [("token-ios-1", {"platform": "ios", "topics": [self.news]})])
+        self.assertEqual(
+            set(changes.all()),
+            {
+                ("token-ios-0", self.default.pk, FCMSubscriptionChange.Action.SUBSCRIBE),
+                ("token-ios-0", self.news.pk, FCMSubscriptionChange.Action.SUBSCRIBE),
+                ("token-ios-1", self.news.pk, FCMSubscriptionChange.Action.SUBSCRIBE),
+            },
+        )
+        self.assertFalse(FCMDevice.objects.filter(disabled_at__isnull=False).exists())
+
+    @override_settings(FCM_SUBSCRIPTION_MAX_ATTEMPTS=2)
+    def test_retry_rejected_changes(self, subscribe_to_topic, unsubscribe_from_topic):
+        for i in (8, 9):
+            FCMDevice.objects.get(registration_id=f"token-ios-{i}").topics.remove(self.news)
+        self.assertEqual(sync_subscription_changes(), {"subscribed": 0, "unsubscribed": 1, "failed": 1})
+        change = FCMSubscriptionChange.objects.get()
+        self.assertEqual((change.registration_id, change.attempts), ("token-ios-9", 1))
+
+        self.assertEqual(sync_subscription_changes(), {"subscribed": 0, "unsubscribed": 0, "failed": 1})
+        self.assertFalse(FCMSubscriptionChange.objects.exists())
+
+
+@mock.patch("firebase_push.engines.http.HTTPSendEngine.get_access_token", return_value="access-token")
+class HTTPSendEngineTestMixin:
+    def test_send(self, get_access_token):
+        msg = self.make_message()
+        msg.add_topic("news")
+        unregistered = {f"token-android-{i}" for i in range(10)}
+        with FakeFCMServer(unregistered=unregistered) as server, override_settings(FCM_ENDPOINT_URL=server.url):
+            self.assertEqual(send_message(json.dumps(msg.serialize())), {"sent": 10, "failed": 10})
+        tokens = sorted(message["token"] for message in server.messages)
+        self.assertEqual(tokens, sorted(f"token-ios-{i}" for i in range(10)))
+        self.assertEqual(server.messages[0]["notification"], {"title": "Title", "body": "Body"})
+
+        history = FCMHistory.objects.filter(message_id=msg.uuid)
+        self.assertEqual(history.filter(status=FCMHistoryBase.Status.SENT).count(), 10)
+        self.assertEqual(history.filter(status=FCMHistoryBase.Status.FAILED, device=None).count(), 10)
+        self.assertFalse(FCMDevice.objects.filter(registration_id__in=unregistered).exists())
+
+    def test_server_errors(self, get_access_token):
+        msg = self.make_message()
+        msg.add_topic("news")
+        with FakeFCMServer(error_rate=1) as server, override_settings(FCM_ENDPOINT_URL=server.url):
+            self.assertEqual(send_message(json.dumps(msg.serialize())), {"sent": 0, "failed": 20})
+        history = FCMHistory.objects.filter(message_id=msg.uuid, status=FCMHistoryBase.Status.FAILED)
+        self.assertEqual(history.exclude(device=None).count(), 20)
+        self.assertIn("Internal error encountered.", history.first().error_message)
+
+
+@override_settings(FCM_SEND_ENGINE="async")
+class AsyncSendEngineTestCase(HTTPSendEngineTestMixin, PushTestCase):
+    pass
+
+
+@override_settings(FCM_SEND_ENGINE="threads", FCM_SEND_THREADS=4)
+class ThreadedSendEngineTestCase(HTTPSendEngineTestMixin, PushTestCase):
+    pass
+
+
+class AccessTokenTestCase(TestCase):
+    @mock.patch.dict("firebase_push.engines.http._access_tokens", clear=True)
+    def test_access_token_shared(self):
+        token = SimpleNamespace(access_token="access-token", expiry=None)
+        app = SimpleNamespace(name="test", credential=mock.Mock(**{"get_access_token.return_value": token}))
+        for _ in range(2):
+            with HTTPSendEngine(app) as engine:
+                self.assertEqual(engine.get_headers(), {"Authorization": "Bearer access-token"})
+        self.assertEqual(app.credential.get_access_token.call_count, 1)
@@ -1,3 +1,5 @@
+import json
+
 from admin_extra_buttons.api import ExtraButtonsMixin, button
 from django import forms
 from django.contrib import admin, messages
@@ -7,10 +9,11 @@ from django.db.models import Count, Q
 from django.http import HttpRequest
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
+from django.utils.html import format_html
 from django.utils.safestring import SafeString
 from django.utils.translation import gettext_lazy as _
 
-from firebase_push.models import FCMTopic
+from firebase_push.models import FCMCampaign, FCMTopic
 from firebase_push.utils import get_device_model, get_history_model
 
 
@@ -82,6 +85,58 @@ class FCMTopicAdmin(admin.ModelAdmin):
         return instance.device_count
 
 
+@admin.register(FCMCampaign)
+class FCMCampaignAdmin(admin.ModelAdmin):
+    ordering = ("-send_at",)
+    search_fields = ("message_id",)
+    list_display = ("message_id", "status", "send_at", "rate", "progress", "sent", "failed")
+    list_filter = ("status",)
+    fields = (
+        "message_id",
+        "status",
+        "send_at",
+        "rate",
+        "progress",
+        "sent",
+        "failed",
+        "message",
+        "created_at",
+        "updated_at",
+    )
+    readonly_fields = fields
+    actions = ("pause", "resume")
+
+    def has_add_permission(self, request: HttpRequest) -> bool:
+        # Campaigns are created with ``PushMessageBase.send(at=..., rate=...)``
+        return False
+
+    @admin.display(description=_("progress"))
+    def progress(self, instance) -> str:
+        if not instance.shards:
+            return self.get_empty_value_display()
+        return _("{finished} of {shards} shards ({released} released), {messages} of {devices} messages").format(
+            finished=instance.finished_shards,
+            shards=len(instance.shards),
+            released=instance.released_shards,
+            messages=instance.sent + instance.failed,
+            devices=instance.devices,
+        )
+
+    @admin.action(description=_("Pause selected campaigns"))
+    def pause(self, request: HttpRequest, queryset):
+        from firebase_push import campaigns
+
+        count = sum(campaigns.pause(campaign) for campaign in queryset)
+        self.message_user(request, _("Paused {count} campaigns.").format(count=count), messages.SUCCESS)
+
+    @admin.action(description=_("Resume selected campaigns"))
+    def resume(self, request: HttpRequest, queryset):
+        from firebase_push import campaigns
+
+        count = sum(campaigns.resume(campaign) for campaign in queryset)
+        self.message_user(request, _("Resumed {count} campaigns.").format(count=count), messages.SUCCESS)
+
+
 class PushNotificationForm(forms.Form):
     title = forms.CharField(max_length=100, label="Title", required=False)
     body = forms.CharField(max_length=1024, label="Body", required=False)
@@ -102,7 +157,7 @@ class FCMHistoryAdmin(ExtraButtonsMixin, admin.ModelAdmin):
     list_display = ("registration_id", "topic", "status", "created_at", "updated_at")
     list_filter = ("status",)
     raw_id_fields = ("user", "device", "topic")
-    readonly_fields = ("created_at", "updated_at")
+    readonly_fields = ("payload", "created_at", "updated_at")
 
     def get_queryset(self, request: HttpRequest):
         return super().get_queryset(request).select_related("topic", "device")
@@ -117,6 +172,10 @@ class FCMHistoryAdmin(ExtraButtonsMixin, admin.ModelAdmin):
     def topic(self, instance) -> str:
         return instance.topic.name
 
+    @admin.display(description=_("payload"))
+    def payload(self, instance) -> SafeString:
+        return format_html("<pre>{}</pre>", json.dumps(instance.payload, indent=2))
+
     @button()
     def send_notification(self, request):
         context = self.get_common_context(request, title="Upload")
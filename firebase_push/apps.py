@@ -1,7 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class FirebasePushConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "firebase_push"
     label = "firebase_push"
+
+    def ready(self):
+        from firebase_push import signals
+
+        # Subscription changes are only pushed to firebase when it fans out topic messages
+        if getattr(settings, "FCM_SERVER_SIDE_TOPICS", False):
+            signals.connect()
+        if getattr(settings, "FCM_DEVICE_CACHE_TIMEOUT", None) is not None:
+            signals.connect_device_cache()
+        if getattr(settings, "FCM_TOPIC_CACHE_TIMEOUT", None) is not None:
+            signals.connect_topic_registry()
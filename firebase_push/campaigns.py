@@ -0,0 +1,166 @@
+"""
+Scheduled and rate limited sending of messages
+
+``PushMessageBase.send(at=..., rate=...)`` stores the message as a
+``FCMCampaign`` instead of sending it. The ``dispatch_campaigns`` celery task,
+run periodically, starts campaigns that are due by planning device shards
+(see ``PushMessageBase.get_exact_shards()``) and releases the shards as
+``send_message_shard`` tasks while the rate limits allow it. Rate limits are
+shared by all workers, see ``firebase_push.ratelimit``.
+"""
+
+from datetime import datetime
+from typing import Any, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from firebase_push.message import PushMessageBase
+from firebase_push.models import FCMCampaign
+from firebase_push.ratelimit import RateLimiter, acquire_all
+from firebase_push.tasks import record_campaign_progress, send_message, send_message_shard
+
+
+def schedule(message: PushMessageBase, at: Optional[datetime] = None, rate: Optional[int] = None) -> FCMCampaign:
+    """Store a message to be sent by ``dispatch_campaigns``
+
+    :param at: Time to start sending, defaults to now
+    :param rate: Maximum number of messages per minute
+    """
+    return FCMCampaign.objects.create(
+        message_id=message.uuid, message=message.to_json(), send_at=at or timezone.now(), rate=rate
+    )
+
+
+def get_limiters(campaign: FCMCampaign) -> list[RateLimiter]:
+    limiters: list[RateLimiter] = []
+    if campaign.rate:
+        limiters.append(RateLimiter(f"firebase_push:campaign:{campaign.pk}", campaign.rate))
+    if limit := getattr(settings, "FCM_CAMPAIGN_RATE_LIMIT", 600000):
+        limiters.append(RateLimiter("firebase_push:campaigns", limit))
+    return limiters
+
+
+def get_shard_size(campaign: FCMCampaign) -> int:
+    """Maximum number of messages per shard, a shard never exceeds the rate limits"""
+    size = getattr(settings, "FCM_CAMPAIGN_SHARD_SIZE", 1000)
+    for limiter in get_limiters(campaign):
+        size = min(size, limiter.rate)
+    return max(1, size)
+
+
+def start(campaign: FCMCampaign):
+    """Plan the shards of a campaign that is due
+
+    Topic messages that are fanned out by firebase (see
+    ``PushMessageBase.uses_server_side_topics()``) are sent as one task that
+    is not rate limited.
+    """
+    message = PushMessageBase.from_json(campaign.message)
+    if message.uses_server_side_topics():
+        campaign.shards = [None]
+    else:
+        campaign.shards = [list(shard) for shard in message.get_exact_shards(get_shard_size(campaign))]
+        campaign.devices = sum(count for _first_pk, _last_pk, count in campaign.shards)
+    campaign.status = FCMCampaign.Status.SENDING if campaign.shards else FCMCampaign.Status.DONE
+    campaign.save(update_fields=["shards", "devices", "status", "updated_at"])
+
+
+def dispatch(campaign: FCMCampaign) -> int:
+    """Release the shards of a sending campaign the rate limits allow
+
+    Each shard takes its number of messages in tokens from the limiters,
+    shards are only sent when the surrounding transaction commits.
+
+    :returns: Number of released shards
+    """
+    limiters = get_limiters(campaign)
+    size = get_shard_size(campaign)
+    released = 0
+    while campaign.released_shards < len(campaign.shards):
+        shard = campaign.shards[campaign.released_shards]
+        # Only a device addressed by more topics than the shard size exceeds it,
+        # more tokens than the limits allow could never be taken
+        if shard is not None and not acquire_all(limiters, min(shard[2], size)):
+            break
+        if shard is None:
+            task, args = send_message, (campaign.message,)
+        else:
+            task, args = send_message_shard, (campaign.message, shard[0], shard[1])
+        transaction.on_commit(
+            lambda task=task, args=args: task.apply_async(
+                args=args,
+                link=record_campaign_progress.s(campaign.pk),
+                link_error=record_campaign_progress.si({}, campaign.pk),
+            )
+        )
+        campaign.released_shards += 1
+        released += 1
+    if released:
+        campaign.save(update_fields=["released_shards", "updated_at"])
+    return released
+
+
+def dispatch_due() -> int:
+    """Start due campaigns and release their shards, see ``dispatch_campaigns``
+
+    Campaigns that another dispatcher is working on are skipped.
+
+    :returns: Number of released shards
+    """
+    due = FCMCampaign.objects.filter(
+        Q(status=FCMCampaign.Status.SCHEDULED, send_at__lte=timezone.now()) | Q(status=FCMCampaign.Status.SENDING)
+    )
+    released = 0
+    for pk in due.order_by("send_at").values_list("pk", flat=True):
+        with transaction.atomic():
+            campaign = (
+                FCMCampaign.objects.select_for_update(skip_locked=True)
+                .filter(pk=pk, status__in=[FCMCampaign.Status.SCHEDULED, FCMCampaign.Status.SENDING])
+                .first()
+            )
+            if campaign is None:
+                continue
+            if campaign.status == FCMCampaign.Status.SCHEDULED:
+                start(campaign)
+            if campaign.status == FCMCampaign.Status.SENDING:
+                released += dispatch(campaign)
+    return released
+
+
+def record_progress(campaign_id: int, result: dict[str, Any]):
+    """Count the result of a finished shard, campaigns are done when all shards finished"""
+    FCMCampaign.objects.filter(pk=campaign_id).update(
+        finished_shards=F("finished_shards") + 1,
+        sent=F("sent") + result.get("sent", 0),
+        failed=F("failed") + result.get("failed", 0),
+        updated_at=timezone.now(),
+    )
+    campaign = FCMCampaign.objects.filter(pk=campaign_id).only("shards", "finished_shards").first()
+    if campaign is not None and campaign.finished_shards >= len(campaign.shards):
+        FCMCampaign.objects.filter(pk=campaign_id).update(status=FCMCampaign.Status.DONE, updated_at=timezone.now())
+
+
+def pause(campaign: FCMCampaign) -> bool:
+    """Stop releasing shards of a campaign, shards that were released are still sent
+
+    :returns: ``False`` if the campaign is already paused or done
+    """
+    updated = FCMCampaign.objects.filter(
+        pk=campaign.pk, status__in=[FCMCampaign.Status.SCHEDULED, FCMCampaign.Status.SENDING]
+    ).update(status=FCMCampaign.Status.PAUSED, updated_at=timezone.now())
+    return updated > 0
+
+
+def resume(campaign: FCMCampaign) -> bool:
+    """Continue a paused campaign
+
+    :returns: ``False`` if the campaign is not paused
+    """
+    status = FCMCampaign.Status.SENDING if campaign.shards else FCMCampaign.Status.SCHEDULED
+    updated = FCMCampaign.objects.filter(pk=campaign.pk, status=FCMCampaign.Status.PAUSED).update(
+        status=status, updated_at=timezone.now()
+    )
+    return updated > 0
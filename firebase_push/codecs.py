@@ -0,0 +1,104 @@
+"""
+Encodes serialized messages for celery tasks
+
+The codec is configured with ``FCM_TASK_CODEC``. Encoded payloads are tagged
+with the format version and the codec, so workers decode tasks that were
+queued with a different codec, and untagged payloads of earlier versions are
+read as plain JSON.
+"""
+
+import base64
+import json
+from functools import lru_cache
+from typing import Any, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+# Version of the payload format, increment on incompatible changes of ``PushMessageBase.serialize()``
+VERSION = 1
+PREFIX = "fcm:"
+
+
+class Codec:
+    """Converts serialized messages from and to strings, the default uses the ``json`` module
+
+    Serialized messages only contain JSON types, see ``PushMessageBase.serialize()``.
+    """
+
+    def dumps(self, data: dict[str, Any]) -> str:
+        return json.dumps(data, separators=(",", ":"))
+
+    def loads(self, payload: str) -> dict[str, Any]:
+        return json.loads(payload)
+
+
+class OrjsonCodec(Codec):
+    """Encodes with ``orjson``, requires the ``orjson`` package"""
+
+    def __init__(self) -> None:
+        try:
+            import orjson
+        except ImportError:
+            raise ImproperlyConfigured("The orjson codec requires the orjson package")
+
+        self.orjson = orjson
+
+    def dumps(self, data: dict[str, Any]) -> str:
+        return self.orjson.dumps(data).decode("utf-8")
+
+    def loads(self, payload: str) -> dict[str, Any]:
+        return self.orjson.loads(payload)
+
+
+class MsgpackCodec(Codec):
+    """Encodes with ``msgpack``, requires the ``msgpack`` package
+
+    Celery serializes task arguments as JSON, so the binary data is base64
+    encoded.
+    """
+
+    def __init__(self) -> None:
+        try:
+            import msgpack
+        except ImportError:
+            raise ImproperlyConfigured("The msgpack codec requires the msgpack package")
+
+        self.msgpack = msgpack
+
+    def dumps(self, data: dict[str, Any]) -> str:
+        return base64.b64encode(self.msgpack.packb(data)).decode("ascii")
+
+    def loads(self, payload: str) -> dict[str, Any]:
+        return self.msgpack.unpackb(base64.b64decode(payload))
+
+
+CODECS = {
+    "json": "firebase_push.codecs.Codec",
+    "orjson": "firebase_push.codecs.OrjsonCodec",
+    "msgpack": "firebase_push.codecs.MsgpackCodec",
+}
+
+
+@lru_cache(maxsize=None)
+def get_codec(name: str) -> Codec:
+    """Return the codec with the name, one of ``CODECS`` or the dotted path to a ``Codec`` subclass"""
+    return import_string(CODECS.get(name, name))()
+
+
+def encode(data: dict[str, Any], name: Optional[str] = None) -> str:
+    """Encode a serialized message with the codec ``name``, defaults to ``FCM_TASK_CODEC``"""
+    name = name or getattr(settings, "FCM_TASK_CODEC", "json")
+    return f"{PREFIX}{VERSION}:{name}:{get_codec(name).dumps(data)}"
+
+
+def decode(payload: str) -> dict[str, Any]:
+    """Decode a payload of ``encode()``, the codec is taken from the payload"""
+    if not payload.startswith(PREFIX):
+        return json.loads(payload)
+    version, name, data = payload[len(PREFIX) :].split(":", 2)
+    if int(version) != VERSION:
+        raise ValueError(f"Unsupported message payload version {version}")
+    return get_codec(name).loads(data)
@@ -1 +1,28 @@
 FCM_FETCH_USER_FUNCTION = "firebase_push.defaults.get_user"
+FCM_SEND_BATCH_SIZE = 500
+FCM_SHARD_SIZE = None
+FCM_SEND_COMPLETE_TASK = None
+FCM_HISTORY_FLUSH_SIZE = 500
+FCM_SEND_ENGINE = "batch"
+FCM_SEND_CONCURRENCY = 100
+FCM_SEND_TIMEOUT = 10
+FCM_ENDPOINT_URL = None
+FCM_SEND_THREADS = 16
+FCM_METRICS_BACKEND = None
+FCM_SERVER_SIDE_TOPICS = False
+FCM_SUBSCRIPTION_SYNC_LIMIT = 10000
+FCM_SUBSCRIPTION_MAX_ATTEMPTS = 5
+FCM_HISTORY_WRITE_BEHIND = False
+FCM_HISTORY_QUEUE = None
+FCM_COMPACT_HISTORY = False
+FCM_CACHE = "default"
+FCM_REGISTRATION_FRESHNESS = None
+FCM_BULK_REGISTRATION_LIMIT = 1000
+FCM_DEVICE_CACHE_TIMEOUT = None
+FCM_DEVICE_CACHE_MAX_DEVICES = 1000
+FCM_DEVICE_CACHE_MAX_USERS = 1000
+FCM_TOPIC_CACHE_TIMEOUT = None
+FCM_MAX_INLINE_TARGETS = None
+FCM_TASK_CODEC = "json"
+FCM_CAMPAIGN_SHARD_SIZE = 1000
+FCM_CAMPAIGN_RATE_LIMIT = 600000
@@ -0,0 +1,138 @@
+"""
+Caches which active devices users and topics resolve to
+
+Enabled with ``FCM_DEVICE_CACHE_TIMEOUT``. Messages to users and topics are
+then fanned out from the cache instead of querying the devices every time.
+
+Entries of a user are removed when one of the devices of the user changes,
+entries of topics are invalidated together whenever any device or
+subscription changes. Changes made through the ORM are tracked with model
+signals (see ``firebase_push.signals``), bulk changes of ``firebase_push``
+itself invalidate explicitly. Changes with ``QuerySet.update()`` or raw SQL
+elsewhere have to call ``invalidate()``.
+"""
+
+from typing import Collection, Iterable, NamedTuple, Optional
+
+from django.conf import settings
+from django.db.models import Count
+
+from firebase_push.utils import cache_incr, get_cache, get_device_model
+
+
+FCMDevice = get_device_model()
+
+GENERATION_KEY = "firebase_push:devices:generation"
+TOPIC_GENERATION_KEY = "firebase_push:devices:topic_generation"
+
+# Marker for topics with more devices than ``FCM_DEVICE_CACHE_MAX_DEVICES``
+TOO_LARGE = "too large"
+
+
+class CachedDevice(NamedTuple):
+    id: int
+    registration_id: str
+    user_id: int
+    platform: str
+    topic_ids: tuple[int, ...]
+
+
+def enabled() -> bool:
+    return getattr(settings, "FCM_DEVICE_CACHE_TIMEOUT", None) is not None
+
+
+def caches_users(user_ids: Collection[int]) -> bool:
+    """Whether the devices of users are resolved from the cache, more than ``FCM_DEVICE_CACHE_MAX_USERS`` are not"""
+    return enabled() and len(user_ids) <= getattr(settings, "FCM_DEVICE_CACHE_MAX_USERS", 1000)
+
+
+def _generations() -> tuple[int, int]:
+    generations = get_cache().get_many([GENERATION_KEY, TOPIC_GENERATION_KEY])
+    return generations.get(GENERATION_KEY, 0), generations.get(TOPIC_GENERATION_KEY, 0)
+
+
+def _load(devices) -> dict[int, CachedDevice]:
+    """Load active devices with their topics in one query, grouped by device id"""
+    rows = devices.filter(disabled_at__isnull=True).values_list(
+        "id", "registration_id", "user_id", "platform", "topics"
+    )
+    loaded: dict[int, CachedDevice] = {}
+    for device_id, registration_id, user_id, platform, topic_id in rows.order_by("pk"):
+        device = loaded.get(device_id) or CachedDevice(device_id, registration_id, user_id, platform, ())
+        if topic_id is not None:
+            device = device._replace(topic_ids=device.topic_ids + (topic_id,))
+        loaded[device_id] = device
+    return loaded
+
+
+def get_user_devices(user_ids: Iterable[int]) -> dict[int, list[CachedDevice]]:
+    """Return the active devices of users, missing users are loaded with one query"""
+    cache = get_cache()
+    generation, _ = _generations()
+    keys = {user_id: f"firebase_push:devices:{generation}:user:{user_id}" for user_id in user_ids}
+    cached = cache.get_many(keys.values())
+
+    result = {user_id: cached[key] for user_id, key in keys.items() if key in cached}
+    missing = [user_id for user_id in keys if user_id not in result]
+    if missing:
+        loaded = {user_id: [] for user_id in missing}
+        for device in _load(FCMDevice.objects.filter(user_id__in=missing)).values():
+            loaded[device.user_id].append(device)
+        cache.set_many({keys[user_id]: devices for user_id, devices in loaded.items()}, timeout=_timeout())
+        result.update(loaded)
+    return result
+
+
+def get_topic_devices(topics: dict[str, int]) -> Optional[dict[str, list[CachedDevice]]]:
+    """Return the active devices subscribed to topics, missing topics are loaded with one query
+
+    :param topics: Topic ids by name
+    :returns: Devices by topic name, or ``None`` if one of the topics has too many devices to be cached
+    """
+    cache = get_cache()
+    generation, topic_generation = _generations()
+    keys = {name: f"firebase_push:devices:{generation}:{topic_generation}:topic:{name}" for name in topics}
+    cached = cache.get_many(keys.values())
+
+    result = {name: cached[key] for name, key in keys.items() if key in cached}
+    if any(devices == TOO_LARGE for devices in result.values()):
+        return None
+    missing = {name: topic_id for name, topic_id in topics.items() if name not in result}
+    if missing:
+        names = {topic_id: name for name, topic_id in missing.items()}
+        # Count first, so the devices of topics that are too large are never loaded
+        max_devices = getattr(settings, "FCM_DEVICE_CACHE_MAX_DEVICES", 1000)
+        counts = (
+            FCMDevice.objects.filter(disabled_at__isnull=True, topics__in=names)
+            .values_list("topics")
+            .annotate(count=Count("pk"))
+        )
+        too_large = [names[topic_id] for topic_id, count in counts if count > max_devices]
+        if too_large:
+            cache.set_many({keys[name]: TOO_LARGE for name in too_large}, timeout=_timeout())
+            return None
+
+        loaded: dict[str, list[CachedDevice]] = {name: [] for name in missing}
+        for device in _load(FCMDevice.objects.filter(pk__in=FCMDevice.objects.filter(topics__in=names))).values():
+            for topic_id in device.topic_ids:
+                if topic_id in names:
+                    loaded[names[topic_id]].append(device)
+        cache.set_many({keys[name]: devices for name, devices in loaded.items()}, timeout=_timeout())
+        result.update(loaded)
+    return result
+
+
+def invalidate(user_ids: Iterable[Optional[int]] = ()):
+    """Invalidate the entries of users and all topic entries"""
+    generation, _ = _generations()
+    get_cache().delete_many([f"firebase_push:devices:{generation}:user:{user_id}" for user_id in user_ids])
+    cache_incr(TOPIC_GENERATION_KEY)
+
+
+def invalidate_all():
+    """Invalidate all entries, for changes that may affect many users"""
+    cache_incr(GENERATION_KEY)
+
+
+def _timeout() -> Optional[int]:
+    return getattr(settings, "FCM_DEVICE_CACHE_TIMEOUT", None)
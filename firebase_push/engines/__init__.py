@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from firebase_admin import App
+
+from .base import SendEngine, SendResult
+
+
+ENGINES = {
+    "batch": "firebase_push.engines.batch.BatchSendEngine",
+    "async": "firebase_push.engines.aio.AsyncSendEngine",
+    "threads": "firebase_push.engines.threaded.ThreadedSendEngine",
+}
+
+
+def get_engine(app: App) -> SendEngine:
+    """
+    Return an instance of the send engine configured with ``FCM_SEND_ENGINE``.
+
+    The setting is either one of the names in ``ENGINES`` or the dotted path
+    to a ``SendEngine`` subclass.
+    """
+    name = getattr(settings, "FCM_SEND_ENGINE", "batch")
+    return import_string(ENGINES.get(name, name))(app)
+
+
+__all__ = ["SendEngine", "SendResult", "get_engine"]
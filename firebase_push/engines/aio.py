@@ -0,0 +1,78 @@
+import asyncio
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from firebase_admin import App, exceptions
+from firebase_admin.messaging import Message
+
+from .base import SendResult
+from .http import HTTPSendEngine
+
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    HTTP2_AVAILABLE = False
+
+
+class AsyncSendEngine(HTTPSendEngine):
+    """Sends messages concurrently with an asyncio ``httpx`` client
+
+    Talks to the FCM HTTP v1 endpoint directly over one pooled (HTTP/2 if
+    the ``h2`` package is installed) connection, the number of requests in
+    flight is limited by ``FCM_SEND_CONCURRENCY``.
+
+    Requires ``httpx`` to be installed.
+    """
+
+    name = "async"
+
+    def __init__(self, app: App) -> None:
+        if httpx is None:
+            raise ImproperlyConfigured("The async send engine requires the httpx package")
+        super().__init__(app)
+        self.concurrency = getattr(settings, "FCM_SEND_CONCURRENCY", 100)
+        self.loop = asyncio.new_event_loop()
+        self.client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+
+    def close(self):
+        self.loop.run_until_complete(self.client.aclose())
+        self.loop.close()
+
+    def send(self, messages: list[Message]) -> list[SendResult]:
+        try:
+            url = self.get_url()
+            headers = self.get_headers()
+        except Exception as e:
+            return [(None, e)] * len(messages)
+        return self.loop.run_until_complete(self.send_all(url, headers, messages))
+
+    async def send_all(self, url: str, headers: dict[str, str], messages: list[Message]) -> list[SendResult]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(message: Message) -> SendResult:
+            async with semaphore:
+                try:
+                    response = await self.client.post(url, headers=headers, json=self.encode(message))
+                except httpx.TimeoutException as e:
+                    return None, exceptions.DeadlineExceededError(f"Timed out while sending message: {e}", cause=e)
+                except httpx.TransportError as e:
+                    return None, exceptions.UnavailableError(f"Failed to establish a connection: {e}", cause=e)
+                except Exception as e:
+                    return None, e
+            if response.is_success:
+                return response.json()["name"], None
+            return None, self.build_error(response)
+
+        return await asyncio.gather(*[send_one(message) for message in messages])
@@ -0,0 +1,40 @@
+from typing import Optional, Tuple
+
+from firebase_admin import App
+from firebase_admin.messaging import Message
+
+
+# Result of sending one message: firebase message id or the exception that occurred
+SendResult = Tuple[Optional[str], Optional[Exception]]
+
+
+class SendEngine:
+    """Base class of the engines that transmit messages to firebase
+
+    An engine is used as a context manager for the duration of one
+    ``send_message`` task, so it can keep connections open between batches.
+    """
+
+    # Name of the engine, used to tag metrics
+    name = "base"
+
+    def __init__(self, app: App) -> None:
+        self.app = app
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def send(self, messages: list[Message]) -> list[SendResult]:
+        """Send a batch of messages
+
+        Errors for individual messages are returned instead of raised.
+
+        :returns: One result per message, in the same order as ``messages``
+        """
+        raise NotImplementedError()
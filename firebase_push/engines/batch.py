@@ -0,0 +1,17 @@
+from firebase_admin import messaging
+from firebase_admin.messaging import Message
+
+from .base import SendEngine, SendResult
+
+
+class BatchSendEngine(SendEngine):
+    """Sends each batch with one ``send_each`` call of the firebase SDK"""
+
+    name = "batch"
+
+    def send(self, messages: list[Message]) -> list[SendResult]:
+        try:
+            batch_response = messaging.send_each(messages, app=self.app)
+        except Exception as e:
+            return [(None, e)] * len(messages)
+        return [(response.message_id, response.exception) for response in batch_response.responses]
@@ -0,0 +1,89 @@
+import threading
+import time
+from datetime import timezone
+from typing import Any
+
+from django.conf import settings
+from firebase_admin import App, exceptions, messaging
+from firebase_admin.messaging import Message
+
+from .base import SendEngine
+
+
+FCM_ENDPOINT_URL = "https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
+
+FCM_ERROR_TYPES = {
+    "APNS_AUTH_ERROR": messaging.ThirdPartyAuthError,
+    "QUOTA_EXCEEDED": messaging.QuotaExceededError,
+    "SENDER_ID_MISMATCH": messaging.SenderIdMismatchError,
+    "THIRD_PARTY_AUTH_ERROR": messaging.ThirdPartyAuthError,
+    "UNREGISTERED": messaging.UnregisteredError,
+}
+
+# OAuth access tokens by app name, shared by all engines of the process
+_access_tokens: dict[str, tuple[str, float]] = {}
+_access_tokens_lock = threading.Lock()
+
+
+def get_access_token(app: App) -> str:
+    """Fetch an access token from the app credential
+
+    ``Credential.get_access_token()`` always requests a new token, so tokens
+    are kept per process and reused until shortly before they expire.
+    """
+    with _access_tokens_lock:
+        access_token, expiry = _access_tokens.get(app.name, (None, 0.0))
+        if access_token is None or time.monotonic() > expiry:
+            token = app.credential.get_access_token()
+            access_token = token.access_token
+            lifetime = 3600
+            if token.expiry:
+                # google-auth reports naive UTC datetimes
+                lifetime = token.expiry.replace(tzinfo=token.expiry.tzinfo or timezone.utc).timestamp() - time.time()
+            _access_tokens[app.name] = (access_token, time.monotonic() + lifetime - 60)
+        return access_token
+
+
+class HTTPSendEngine(SendEngine):
+    """Base class for engines that talk to the FCM HTTP v1 endpoint directly
+
+    Authentication uses the OAuth access token of the firebase app credential,
+    the endpoint can be overridden with ``FCM_ENDPOINT_URL``.
+    """
+
+    def __init__(self, app: App) -> None:
+        super().__init__(app)
+        self.url = getattr(settings, "FCM_ENDPOINT_URL", None) or FCM_ENDPOINT_URL
+        self.timeout = getattr(settings, "FCM_SEND_TIMEOUT", 10)
+
+    def get_access_token(self) -> str:
+        return get_access_token(self.app)
+
+    def get_url(self) -> str:
+        if "{project_id}" in self.url:
+            return self.url.format(project_id=self.app.project_id)
+        return self.url
+
+    def get_headers(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.get_access_token()}"}
+
+    def encode(self, message: Message) -> dict[str, Any]:
+        return {"message": messaging._MessagingService.encode_message(message)}
+
+    def build_error(self, response: Any) -> exceptions.FirebaseError:
+        """Convert an error response of the FCM endpoint into a firebase exception
+
+        :param response: ``requests`` or ``httpx`` response object
+        """
+        error: dict[str, Any] = {}
+        try:
+            error = response.json().get("error", {})
+        except ValueError:
+            pass
+
+        message = error.get("message") or f"Unexpected HTTP response with status: {response.status_code}"
+        for detail in error.get("details", []):
+            if detail.get("@type") == "type.googleapis.com/google.firebase.fcm.v1.FcmError":
+                if exc_type := FCM_ERROR_TYPES.get(detail.get("errorCode")):
+                    return exc_type(message, http_response=response)
+        return exceptions.FirebaseError(error.get("status", exceptions.UNKNOWN), message, http_response=response)
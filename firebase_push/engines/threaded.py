@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+from django.conf import settings
+from firebase_admin import App, exceptions
+from firebase_admin.messaging import Message
+from requests.adapters import HTTPAdapter
+
+from .base import SendResult
+from .http import HTTPSendEngine
+
+
+class ThreadedSendEngine(HTTPSendEngine):
+    """Sends messages from a thread pool over one shared ``requests`` session
+
+    Talks to the FCM HTTP v1 endpoint directly, the size of the thread pool
+    and of the connection pool is configured with ``FCM_SEND_THREADS``.
+    Results are collected in the calling thread, so history bookkeeping
+    happens outside of the pool.
+    """
+
+    name = "threads"
+
+    def __init__(self, app: App) -> None:
+        super().__init__(app)
+        self.threads = max(1, getattr(settings, "FCM_SEND_THREADS", 16))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.threads)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="fcm-send")
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def send(self, messages: list[Message]) -> list[SendResult]:
+        try:
+            url = self.get_url()
+            headers = self.get_headers()
+        except Exception as e:
+            return [(None, e)] * len(messages)
+        return list(self.executor.map(partial(self.send_one, url, headers), messages))
+
+    def send_one(self, url: str, headers: dict[str, str], message: Message) -> SendResult:
+        try:
+            response = self.session.post(url, headers=headers, json=self.encode(message), timeout=self.timeout)
+        except requests.Timeout as e:
+            return None, exceptions.DeadlineExceededError(f"Timed out while sending message: {e}", cause=e)
+        except requests.RequestException as e:
+            return None, exceptions.UnavailableError(f"Failed to establish a connection: {e}", cause=e)
+        except Exception as e:
+            return None, e
+        if response.ok:
+            return response.json()["name"], None
+        return None, self.build_error(response)
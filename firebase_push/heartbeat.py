@@ -0,0 +1,83 @@
+"""
+Skips writes of unchanged device registrations
+
+Apps register their device on every launch, mostly with unchanged data. With
+``FCM_REGISTRATION_FRESHNESS`` set, the values of a written registration are
+remembered in the cache. A registration with the same data is answered from
+the cache without a write while the remembered ``updated_at`` is within the
+freshness window, so ``updated_at`` of a device that keeps registering is never
+older than the window.
+"""
+
+import hashlib
+import json
+from datetime import timedelta
+from typing import Any, Iterable, Optional
+
+from django.conf import settings
+from django.db.models import Model
+from django.utils import timezone
+
+from firebase_push.utils import get_cache, get_device_model
+
+
+FCMDevice = get_device_model()
+
+
+def get_freshness() -> Optional[timedelta]:
+    seconds = getattr(settings, "FCM_REGISTRATION_FRESHNESS", None)
+    return timedelta(seconds=seconds) if seconds else None
+
+
+def fingerprint(registration_id: str, user: Any, data: dict[str, Any]) -> str:
+    """Hash of the registration data sent by a device"""
+    data = dict(data, registration_id=registration_id, user=user)
+    if data.get("topics") is not None:
+        data["topics"] = sorted(topic.name for topic in data["topics"])
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def remember(registration_id: str, fingerprint: str, device: Model):
+    """Remember the values of a written registration for the freshness window"""
+    freshness = get_freshness()
+    if freshness is None:
+        return
+    values = {field.attname: getattr(device, field.attname) for field in FCMDevice._meta.concrete_fields}
+    get_cache().set(
+        f"firebase_push:registration:{registration_id}",
+        (fingerprint, values),
+        timeout=freshness.total_seconds(),
+    )
+
+
+def get_fresh(registration_id: str, fingerprint: str) -> Optional[dict[str, Any]]:
+    """Return the remembered values of a registration if it is unchanged and fresh
+
+    The device has to still exist, belong to the same user and be enabled,
+    which is checked with one primary key lookup.
+
+    :returns: Field values of the device or ``None`` if the registration has to be written
+    """
+    freshness = get_freshness()
+    if freshness is None:
+        return None
+    cached = get_cache().get(f"firebase_push:registration:{registration_id}")
+    if cached is None or cached[0] != fingerprint:
+        return None
+    values = cached[1]
+    if values["updated_at"] < timezone.now() - freshness:
+        return None
+    # The device may have been deleted, disabled or taken over since it was remembered
+    if not FCMDevice.objects.filter(
+        pk=values["id"], registration_id=registration_id, user_id=values["user_id"], disabled_at__isnull=True
+    ).exists():
+        forget([registration_id])
+        return None
+    return values
+
+
+def forget(registration_ids: Iterable[str]):
+    """Drop remembered registrations, their next registration is written"""
+    if get_freshness() is None:
+        return
+    get_cache().delete_many([f"firebase_push:registration:{registration_id}" for registration_id in registration_ids])
@@ -0,0 +1,99 @@
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.core import serializers
+from django.utils import timezone
+
+from firebase_push import metrics
+from firebase_push.models import FCMHistoryBase
+from firebase_push.utils import get_history_model
+
+
+FCMHistory = get_history_model()
+
+
+class HistoryWriter:
+    """Collects changed history entries and writes them in bulk
+
+    Entries are written with one ``bulk_update`` call each time ``flush_size``
+    entries have been collected and when the writer is flushed or its context
+    is left. Like ``bulk_create`` this does not call ``save()`` or fire signals.
+
+    Only the fields in ``update_fields`` are written.
+    """
+
+    update_fields = ("device", "status", "error_message", "updated_at")
+
+    def __init__(self, flush_size: Optional[int] = None) -> None:
+        if flush_size is None:
+            flush_size = getattr(settings, "FCM_HISTORY_FLUSH_SIZE", 500)
+        self.flush_size = max(1, flush_size)
+        self.pending: list[FCMHistoryBase] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, entries: Iterable[FCMHistoryBase]):
+        now = timezone.now()
+        for entry in entries:
+            # ``auto_now`` is not applied by ``bulk_update``
+            entry.updated_at = now
+            self.pending.append(entry)
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with metrics.timer("history_flush"):
+            FCMHistory.objects.bulk_update(self.pending, self.update_fields, batch_size=self.flush_size)
+        self.pending = []
+
+
+class WriteBehindHistoryWriter(HistoryWriter):
+    """Collects history entries and hands them to a celery task that creates them
+
+    Used when ``FCM_HISTORY_WRITE_BEHIND`` is enabled. The entries are not
+    created before sending in that case, so sending does not wait on history
+    writes. Each flush serializes the collected entries and queues one
+    ``write_history`` task on ``FCM_HISTORY_QUEUE``.
+    """
+
+    def add(self, entries: Iterable[FCMHistoryBase]):
+        entries = list(entries)
+        now = timezone.now()
+        for entry in entries:
+            # ``write_history`` stores the time of sending as it is
+            if entry.created_at is None:
+                entry.created_at = now
+        super().add(entries)
+
+    def flush(self):
+        from firebase_push.tasks import write_history
+
+        if not self.pending:
+            return
+        with metrics.timer("history_flush"):
+            write_history.apply_async(
+                args=(serializers.serialize("json", self.pending),),
+                queue=getattr(settings, "FCM_HISTORY_QUEUE", None),
+            )
+        self.pending = []
+
+
+def get_history_writer() -> HistoryWriter:
+    """Return the history writer for a send, depending on ``FCM_HISTORY_WRITE_BEHIND``"""
+    if write_behind():
+        return WriteBehindHistoryWriter()
+    return HistoryWriter()
+
+
+def write_behind() -> bool:
+    return getattr(settings, "FCM_HISTORY_WRITE_BEHIND", False)
+
+
+def compact_history() -> bool:
+    return getattr(settings, "FCM_COMPACT_HISTORY", False)
@@ -1,18 +1,61 @@
+import time
 from datetime import timedelta
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
 from django.utils import timezone
 
+from firebase_push import device_cache
+from firebase_push.models import FCMSubscriptionChange
 from firebase_push.utils import get_device_model
 
 
 FCMDevice = get_device_model()
 
 
-def age_devices(days: int):
-    devices = FCMDevice.objects.filter(updated_at__lt=timezone.now() - timedelta(days=days))
-    count = devices.count()
-    devices.update(disabled_at=timezone.now())
+def age_devices(days: int, batch_size: int = 1000, sleep: float = 0, stdout=None):
+    """Disable enabled devices that have not been updated for ``days`` days
+
+    Devices are updated in primary key ranges of ``batch_size`` with ``sleep``
+    seconds between batches, so no single statement locks large parts of the
+    table. When ``FCM_SERVER_SIDE_TOPICS`` is enabled the disabled devices are
+    unsubscribed from their topics on firebase, registering re-enables them.
+
+    :returns: Number of disabled devices
+    """
+    now = timezone.now()
+    devices = FCMDevice.objects.filter(disabled_at__isnull=True, updated_at__lt=now - timedelta(days=days))
+    bounds = devices.aggregate(first=Min("pk"), last=Max("pk"))
+    if bounds["first"] is None:
+        return 0
+
+    server_side_topics = getattr(settings, "FCM_SERVER_SIDE_TOPICS", False)
+    count = 0
+    for first_pk in range(bounds["first"], bounds["last"] + 1, batch_size):
+        batch = devices.filter(pk__range=(first_pk, first_pk + batch_size - 1))
+        with transaction.atomic():
+            if server_side_topics:
+                # Registering waits, so re-enabled devices are not unsubscribed
+                subscriptions = batch.select_for_update(of=("self",)).filter(topics__isnull=False)
+                FCMSubscriptionChange.objects.bulk_create(
+                    FCMSubscriptionChange(
+                        registration_id=registration_id,
+                        topic_id=topic_id,
+                        action=FCMSubscriptionChange.Action.UNSUBSCRIBE,
+                    )
+                    for registration_id, topic_id in subscriptions.values_list("registration_id", "topics")
+                )
+            # ``update()`` does not touch ``updated_at``
+            count += batch.update(disabled_at=now)
+        if stdout is not None:
+            stdout.write(f"Disabled {count} devices...")
+        if sleep:
+            time.sleep(sleep)
+    # ``update()`` sends no signals
+    if count and device_cache.enabled():
+        device_cache.invalidate_all()
     return count
 
 
@@ -28,9 +71,29 @@ class Command(BaseCommand):
             type=int,
             help="Device is disabled when it has not been seen for this number of days",
         )
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            dest="batch_size",
+            default=1000,
+            type=int,
+            help="Size of the primary key ranges that are updated at once",
+        )
+        parser.add_argument(
+            "--sleep",
+            dest="sleep",
+            default=0,
+            type=float,
+            help="Seconds to wait between batches",
+        )
 
     def handle(self, *args, **options):
-        result = age_devices(days=options["since"])
+        result = age_devices(
+            days=options["since"],
+            batch_size=options["batch_size"],
+            sleep=options["sleep"],
+            stdout=self.stdout if options["verbosity"] > 1 else None,
+        )
         if result > 0:
             self.stdout.write(self.style.SUCCESS(f"Successfully disabled {result} devices!"))
         else:
@@ -1,18 +1,33 @@
+import time
 from datetime import timedelta
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
-from firebase_push.utils import get_device_model
+from firebase_push.utils import fast_delete, get_device_model
 
 
 FCMDevice = get_device_model()
 
 
-def cleanup_devices(days: int):
-    devices = FCMDevice.objects.filter(disabled_at__lt=timezone.now() - timedelta(days=days))
-    count = devices.count()
-    devices.delete()
+def cleanup_devices(days: int, batch_size: int = 1000, sleep: float = 0, stdout=None):
+    """Delete devices that have been disabled for ``days`` days
+
+    Devices are deleted in batches of ``batch_size`` in primary key order with
+    ``sleep`` seconds between batches. An interrupted cleanup continues where
+    it stopped when it is run again.
+
+    :returns: Number of deleted devices
+    """
+    devices = FCMDevice.objects.filter(disabled_at__lt=timezone.now() - timedelta(days=days)).order_by("pk")
+
+    count = 0
+    while pks := list(devices.values_list("pk", flat=True)[:batch_size]):
+        count += fast_delete(FCMDevice.objects.filter(pk__in=pks))
+        if stdout is not None:
+            stdout.write(f"Removed {count} devices...")
+        if sleep:
+            time.sleep(sleep)
     return count
 
 
@@ -28,9 +43,29 @@ class Command(BaseCommand):
             type=int,
             help="Device is discarded when it has been disabled for this number of days",
         )
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            dest="batch_size",
+            default=1000,
+            type=int,
+            help="Number of devices that are deleted at once",
+        )
+        parser.add_argument(
+            "--sleep",
+            dest="sleep",
+            default=0,
+            type=float,
+            help="Seconds to wait between batches",
+        )
 
     def handle(self, *args, **options):
-        result = cleanup_devices(days=options["since"])
+        result = cleanup_devices(
+            days=options["since"],
+            batch_size=options["batch_size"],
+            sleep=options["sleep"],
+            stdout=self.stdout if options["verbosity"] > 1 else None,
+        )
         if result > 0:
             self.stdout.write(self.style.SUCCESS(f"Successfully removed {result} devices!"))
         else:
@@ -1,20 +1,49 @@
+import time
+from collections import Counter
 from datetime import timedelta
 
 from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 
-from firebase_push.models import FCMHistoryBase
-from firebase_push.utils import get_history_model
+from firebase_push.models import FCMCampaign, FCMHistoryBase, FCMMessagePayload, FCMMessageTargets
+from firebase_push.utils import fast_delete, get_history_model
 
 
-def cleanup_history(days: int):
+def cleanup_history(days: int, batch_size: int = 1000, sleep: float = 0, stdout=None):
+    """Delete history entries that have not been updated for ``days`` days
+
+    Entries are deleted in batches of ``batch_size`` in primary key order, each
+    batch in its own statement, with ``sleep`` seconds between batches. An
+    interrupted cleanup continues where it stopped when it is run again.
+
+    :returns: Number of deleted pending, sent and failed entries
+    """
     FCMHistory = get_history_model()
-    entries = FCMHistory.objects.filter(updated_at__lt=timezone.now() - timedelta(days=days))
-    pending = entries.filter(status=FCMHistoryBase.Status.PENDING).count()
-    sent = entries.filter(status=FCMHistoryBase.Status.SENT).count()
-    failed = entries.filter(status=FCMHistoryBase.Status.FAILED).count()
-    entries.delete()
-    return pending, sent, failed
+    cutoff = timezone.now() - timedelta(days=days)
+    entries = FCMHistory.objects.filter(updated_at__lt=cutoff).order_by("pk")
+
+    counts: Counter = Counter()
+    while batch := list(entries.values_list("pk", "status")[:batch_size]):
+        fast_delete(FCMHistory.objects.filter(pk__in=[pk for pk, _ in batch]))
+        counts.update(status for _, status in batch)
+        if stdout is not None:
+            stdout.write(f"Removed {sum(counts.values())} history entries...")
+        if sleep:
+            time.sleep(sleep)
+
+    # Remove payloads of messages without history entries, history of recent messages may still be
+    # written by pending ``write_history`` tasks
+    payloads = FCMMessagePayload.objects.filter(created_at__lt=cutoff)
+    fast_delete(payloads.filter(~Exists(FCMHistory.objects.filter(message_id=OuterRef("pk")))))
+    # Campaigns that have not finished still read their targets
+    unfinished = FCMCampaign.objects.filter(message_id=OuterRef("pk")).exclude(status=FCMCampaign.Status.DONE)
+    fast_delete(FCMMessageTargets.objects.filter(~Exists(unfinished), created_at__lt=cutoff))
+    return (
+        counts[FCMHistoryBase.Status.PENDING],
+        counts[FCMHistoryBase.Status.SENT],
+        counts[FCMHistoryBase.Status.FAILED],
+    )
 
 
 class Command(BaseCommand):
@@ -29,9 +58,29 @@ class Command(BaseCommand):
             type=int,
             help="History is discarded when it is older than this number of days",
         )
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            dest="batch_size",
+            default=1000,
+            type=int,
+            help="Number of history entries that are deleted at once",
+        )
+        parser.add_argument(
+            "--sleep",
+            dest="sleep",
+            default=0,
+            type=float,
+            help="Seconds to wait between batches",
+        )
 
     def handle(self, *args, **options):
-        pending, sent, failed = cleanup_history(days=options["since"])
+        pending, sent, failed = cleanup_history(
+            days=options["since"],
+            batch_size=options["batch_size"],
+            sleep=options["sleep"],
+            stdout=self.stdout if options["verbosity"] > 1 else None,
+        )
         if (pending + sent + failed) > 0:
             self.stdout.write(self.style.SUCCESS(f"Successfully removed {pending + sent + failed} history entries"))
             self.stdout.write(self.style.NOTICE(f"(sent: {sent}, failed: {failed}, still pending: {pending})"))
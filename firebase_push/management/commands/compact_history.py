@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from firebase_push.models import FCMMessagePayload
+from firebase_push.utils import get_history_model
+
+
+# Keys of ``message_data`` that differ between the history entries of a message
+TARGET_KEYS = ("token", "topic", "condition")
+
+
+def split_message_data(message_data: dict) -> tuple[dict, dict]:
+    """Split serialized message data into the shared payload and the target"""
+    payload = {key: value for key, value in message_data.items() if key not in TARGET_KEYS}
+    target = {key: value for key, value in message_data.items() if key in TARGET_KEYS}
+    return payload, target
+
+
+def compact_history(batch_size: int = 1000) -> tuple[int, int]:
+    """Move the shared message data of existing history entries to ``FCMMessagePayload``
+
+    Entries whose data differs from the first entry of their message apart
+    from the target are left untouched. Messages are processed in their own
+    transaction, so this can be interrupted and run again.
+
+    :param batch_size: Number of history entries loaded and updated at once
+    :returns: Number of compacted messages and history entries
+    """
+    FCMHistory = get_history_model()
+    message_ids = (
+        FCMHistory.objects.exclude(message_id__in=FCMMessagePayload.objects.values("message_id"))
+        .values_list("message_id", flat=True)
+        .distinct()
+    )
+
+    messages = entries = 0
+    for message_id in list(message_ids):
+        with transaction.atomic():
+            history = FCMHistory.objects.filter(message_id=message_id).only("id", "message_data").order_by("pk")
+            payload, _ = split_message_data(history.first().message_data)
+            FCMMessagePayload.objects.create(message_id=message_id, data=payload)
+
+            last_pk = 0
+            while batch := list(history.filter(pk__gt=last_pk)[:batch_size]):
+                last_pk = batch[-1].pk
+                changed = []
+                for entry in batch:
+                    data, target = split_message_data(entry.message_data)
+                    if data == payload:
+                        entry.message_data = target
+                        changed.append(entry)
+                FCMHistory.objects.bulk_update(changed, ["message_data"])
+                entries += len(changed)
+        messages += 1
+    return messages, entries
+
+
+class Command(BaseCommand):
+    help = "Store the message data shared by the history entries of a message only once"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            dest="batch_size",
+            default=1000,
+            type=int,
+            help="Number of history entries that are updated at once",
+        )
+
+    def handle(self, *args, **options):
+        messages, entries = compact_history(batch_size=options["batch_size"])
+        if messages > 0:
+            self.stdout.write(self.style.SUCCESS(f"Compacted {entries} history entries of {messages} messages"))
+        else:
+            self.stdout.write(self.style.SUCCESS("No history to compact."))
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from firebase_push.models import FCMMessagePayload
+from firebase_push.partitions import create_partitions, drop_partitions, is_partitioned
+from firebase_push.utils import fast_delete, get_history_model
+
+
+class Command(BaseCommand):
+    help = "Create upcoming and drop old monthly partitions of a partitioned FCM history table (PostgreSQL only)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            "-m",
+            dest="months_ahead",
+            default=2,
+            type=int,
+            help="Number of monthly partitions to create in advance",
+        )
+        parser.add_argument(
+            "--since",
+            "-s",
+            dest="since",
+            default=None,
+            type=int,
+            help="Drop partitions that only hold history older than this number of days",
+        )
+
+    def handle(self, *args, **options):
+        FCMHistory = get_history_model()
+        if not is_partitioned(FCMHistory):
+            raise CommandError(f"{FCMHistory._meta.db_table} is not a partitioned PostgreSQL table")
+
+        created = create_partitions(FCMHistory, months_ahead=options["months_ahead"])
+        for name in created:
+            self.stdout.write(self.style.SUCCESS(f"Created partition {name}"))
+
+        if options["since"] is not None:
+            before = (timezone.now() - timedelta(days=options["since"])).date()
+            dropped = drop_partitions(FCMHistory, before)
+            for name in dropped:
+                self.stdout.write(self.style.SUCCESS(f"Dropped partition {name}"))
+            if dropped:
+                # Remove payloads of messages without history entries, see ``cleanup_history``
+                payloads = FCMMessagePayload.objects.filter(created_at__date__lt=before)
+                fast_delete(payloads.filter(~Exists(FCMHistory.objects.filter(message_id=OuterRef("pk")))))
+
+        if not created and (options["since"] is None or not dropped):
+            self.stdout.write(self.style.SUCCESS("No partitions to change."))
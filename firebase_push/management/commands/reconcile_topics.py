@@ -0,0 +1,91 @@
+from typing import Optional
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+
+from firebase_push.models import FCMSubscriptionChange, FCMTopic
+from firebase_push.subscriptions import get_remote_topics, record_changes
+from firebase_push.utils import get_device_model
+
+
+FCMDevice = get_device_model()
+
+
+def reconcile_topics(topic: Optional[str] = None, fix: bool = False, stdout=None) -> dict[str, int]:
+    """Compare the topic subscriptions of all devices with the subscriptions firebase knows
+
+    Only topics that exist locally are compared, disabled devices should not
+    be subscribed to any topic.
+
+    :param topic: Only compare subscriptions of the topic with this name
+    :param fix: Record the differences in the subscription outbox, so the next
+        ``sync_subscription_changes`` run resolves them
+    :returns: Number of ``checked`` devices, ``missing`` and ``extra`` remote
+        subscriptions and devices ``unknown`` to firebase
+    """
+    from firebase_push.tasks import firebase
+
+    topics = FCMTopic.objects.all()
+    if topic is not None:
+        topics = topics.filter(name=topic)
+    topic_ids = {topic_obj.name: topic_obj.pk for topic_obj in topics}
+
+    devices = FCMDevice.objects.only("id", "registration_id", "disabled_at").order_by("pk")
+    devices = devices.prefetch_related(Prefetch("topics", queryset=topics, to_attr="local_topics"))
+
+    summary = dict(checked=0, missing=0, extra=0, unknown=0)
+    with requests.Session() as session:
+        for device in devices.iterator(chunk_size=500):
+            remote = get_remote_topics(device.registration_id, app=firebase, session=session)
+            summary["checked"] += 1
+            if remote is None:
+                summary["unknown"] += 1
+                continue
+
+            remote &= topic_ids.keys()
+            local = {topic_obj.name for topic_obj in device.local_topics} if device.disabled_at is None else set()
+            missing = local - remote
+            extra = remote - local
+            summary["missing"] += len(missing)
+            summary["extra"] += len(extra)
+            if (missing or extra) and stdout is not None:
+                stdout.write(f"{device.registration_id}: missing {sorted(missing)}, extra {sorted(extra)}")
+            if fix:
+                record_changes(
+                    [device.registration_id],
+                    [topic_ids[name] for name in missing],
+                    FCMSubscriptionChange.Action.SUBSCRIBE,
+                )
+                record_changes(
+                    [device.registration_id],
+                    [topic_ids[name] for name in extra],
+                    FCMSubscriptionChange.Action.UNSUBSCRIBE,
+                )
+    return summary
+
+
+class Command(BaseCommand):
+    help = "Compare local topic subscriptions of devices with the subscriptions firebase knows"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--topic", "-t", dest="topic", default=None, help="Only compare this topic")
+        parser.add_argument(
+            "--fix",
+            dest="fix",
+            action="store_true",
+            help="Queue subscription changes to resolve the differences",
+        )
+
+    def handle(self, *args, **options):
+        result = reconcile_topics(topic=options["topic"], fix=options["fix"], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"Checked {result['checked']} devices"))
+        if result["missing"] or result["extra"]:
+            self.stdout.write(
+                self.style.NOTICE(
+                    f"(missing subscriptions: {result['missing']}, extra subscriptions: {result['extra']}, "
+                    f"unknown to firebase: {result['unknown']})"
+                )
+            )
+        else:
+            self.stdout.write(self.style.SUCCESS(f"No differences found (unknown to firebase: {result['unknown']})"))
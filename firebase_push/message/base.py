@@ -1,11 +1,16 @@
 import json
+import time
+import zlib
 from copy import copy
-from datetime import datetime
-from typing import Any, Optional, Tuple, Union
+from datetime import datetime, timedelta
+from functools import lru_cache
+from math import ceil
+from typing import Any, Iterator, Optional, Tuple, Union
 from uuid import uuid4
 
 from django.conf import settings
-from django.db.models import Model, QuerySet
+from django.db.models import Count, F, Max, Min, Model, QuerySet, Value
+from django.utils import timezone
 from django.utils.module_loading import import_string
 from firebase_admin.messaging import (
     AndroidConfig,
@@ -20,7 +25,9 @@ from firebase_admin.messaging import (
 )
 from typing_extensions import Self
 
-from firebase_push.models import FCMHistoryBase, FCMTopic
+from firebase_push import codecs, device_cache, metrics, topics
+from firebase_push.history import compact_history, write_behind
+from firebase_push.models import FCMHistoryBase, FCMMessagePayload, FCMMessageTargets, FCMTopic
 from firebase_push.tasks import send_message
 from firebase_push.utils import get_device_model, get_history_model
 
@@ -28,6 +35,9 @@ from firebase_push.utils import get_device_model, get_history_model
 FCMHistory = get_history_model()
 FCMDevice = get_device_model()
 
+# Message classes of serialized messages, looked up once per class and process
+get_message_class = lru_cache(maxsize=None)(import_string)
+
 
 class PushMessageBase:
     """Push notification message base class
@@ -79,12 +89,18 @@ class PushMessageBase:
         # Internal message id
         self.uuid = str(uuid4())
 
+        # Topics resolved while sending, by name
+        self._topic_cache: dict[str, FCMTopic] = {}
+
+        # Rendered message and its serialized data, see ``render_cached()``
+        self._rendered: Optional[Tuple[Message, dict[str, Any]]] = None
+
     def serialize(self) -> dict[str, Any]:
         return dict(
             _class=".".join((self.__class__.__module__, self.__class__.__name__)),
             _topics=self._topics,
-            _devices=self._devices,
-            _users=self._users,
+            _devices=list(self._devices),
+            _users=list(self._users),
             collapse_id=self.collapse_id,
             badge_count=self.badge_count,
             data_available=self.data_available,
@@ -92,7 +108,7 @@ class PushMessageBase:
             data=self.data,
             android_icon=self.android_icon,
             color=self.color,
-            expiration=self.expiration,
+            expiration=self.expiration.isoformat() if self.expiration else None,
             is_priority=self.is_priority,
             web_actions=self.web_actions,
             web_icon=self.web_icon,
@@ -110,18 +126,39 @@ class PushMessageBase:
         self.data = data["data"]
         self.android_icon = data["android_icon"]
         self.color = data["color"]
-        self.expiration = data["expiration"]
+        self.expiration = datetime.fromisoformat(data["expiration"]) if data["expiration"] else None
         self.is_priority = data["is_priority"]
         self.web_actions = data["web_actions"]
         self.web_icon = data["web_icon"]
         self.uuid = data["uuid"]
 
+    def to_json(self) -> str:
+        """Serialize the message for a celery task
+
+        The message is encoded with ``FCM_TASK_CODEC``, see
+        ``firebase_push.codecs``. Messages addressed to more than ``FCM_MAX_INLINE_TARGETS`` users and
+        devices store their targets compressed in ``FCMMessageTargets``, the
+        task then only carries a reference, see ``from_json()``.
+        """
+        data = self.serialize()
+        limit = getattr(settings, "FCM_MAX_INLINE_TARGETS", None)
+        if limit is not None and len(data["_users"]) + len(data["_devices"]) > limit:
+            targets = json.dumps({"_users": list(data["_users"]), "_devices": list(data["_devices"])})
+            FCMMessageTargets.objects.update_or_create(
+                message_id=self.uuid, defaults={"data": zlib.compress(targets.encode("utf-8"))}
+            )
+            data.update(_users=[], _devices=[], _targets=self.uuid)
+        return codecs.encode(data)
+
     @classmethod
     def from_json(cls, data: str) -> Self:
-        tree = json.loads(data)
+        tree = codecs.decode(data)
+        if tree.get("_targets"):
+            targets = FCMMessageTargets.objects.get(message_id=tree["_targets"])
+            tree.update(json.loads(zlib.decompress(targets.data)))
 
         # try instanciating class from serialized data
-        klass = import_string(tree["_class"])
+        klass = get_message_class(tree["_class"])
         c = klass()
         c.deserialize(tree)
         return c
@@ -175,7 +212,7 @@ class PushMessageBase:
 
     @users.setter
     def users(self, value: QuerySet):
-        self._users = value.values_list("pk", flat=True)
+        self._users = list(value.values_list("pk", flat=True))
 
     def add_user(self, user: Model):
         self._users.append(user.pk)
@@ -183,12 +220,27 @@ class PushMessageBase:
     def remove_user(self, user: Model):
         self._users.remove(user.pk)
 
+    def get_topic(self, name: str) -> FCMTopic:
+        """Fetch a topic by name, topics that have been resolved by ``fanout()`` are cached"""
+        self.resolve_topics([name])
+        try:
+            return self._topic_cache[name]
+        except KeyError:
+            raise FCMTopic.DoesNotExist(f"Topic {name} does not exist") from None
+
+    def resolve_topics(self, names: list[str]):
+        """Resolve topics that have not been resolved by this message yet, see ``firebase_push.topics``"""
+        missing = [name for name in names if name not in self._topic_cache]
+        if missing:
+            self._topic_cache.update(topics.get_topics(missing))
+
     def create_history_entries(
         self,
         message: Message,
         user: Optional[Model] = None,
         topic: Optional[str] = None,
         device: Optional[FCMDevice] = None,
+        message_data: Optional[dict[str, Any]] = None,
     ) -> list[FCMHistoryBase]:
         """Create a FCMHistory entry for each sent message
 
@@ -199,9 +251,22 @@ class PushMessageBase:
         This will be bulk created, so no fired signals or calls on the
         save() function of the model.
 
+        When called with only a ``topic`` (see ``fanout_topics()``) a single
+        aggregate entry without ``user`` and ``device`` is created for the topic.
+
+        When called from ``fanout()`` the ``device`` is only loaded with the
+        fields ``id``, ``registration_id``, ``user_id`` and ``platform`` and
+        ``user`` is not set, accessing other fields will result in additional
+        queries.
+
+        :param message_data: Serialized ``message``, if not set the message
+            will be serialized again. With ``FCM_COMPACT_HISTORY`` enabled this
+            only contains the ``token`` or ``topic`` of the message.
         :returns: List of unsaved FCMHistory entries
         """
-        message_data = json.loads(str(message))
+        if message_data is None:
+            message_data = json.loads(str(message))
+        topic_obj = self.get_topic(topic) if topic else None
         entries: list[FCMHistory] = []
 
         if user is not None:
@@ -211,91 +276,292 @@ class PushMessageBase:
                     message_id=self.uuid,
                     user=user,
                     device=device,
-                    topic=FCMTopic.objects.get(name=topic) if topic else None,
+                    topic=topic_obj,
                     status=FCMHistoryBase.Status.PENDING,
                 )
             )
-        elif topic and device:
+        elif device:
             entries.append(
                 FCMHistory(
                     message_data=message_data,
                     message_id=self.uuid,
-                    user=device.user,
+                    user_id=device.user_id,
                     device=device,
-                    topic=FCMTopic.objects.get(name=topic),
+                    topic=topic_obj,
                     status=FCMHistoryBase.Status.PENDING,
                 )
             )
-        elif topic:
-            for device in FCMDevice.objects.filter(topic__name=topic, disabled_at__isnull=True):
-                entries.append(
-                    FCMHistory(
-                        message_data=message_data,
-                        message_id=self.uuid,
-                        user=device.user,
-                        device=device,
-                        topic=FCMTopic.objects.get(name=topic),
-                        status=FCMHistoryBase.Status.PENDING,
-                    )
-                )
-        elif device:
+        elif topic_obj:
+            # Topic message that is fanned out by firebase, one aggregate entry
             entries.append(
                 FCMHistory(
                     message_data=message_data,
                     message_id=self.uuid,
-                    device=device,
-                    topic=FCMTopic.objects.get(name=topic) if topic else None,
+                    topic=topic_obj,
                     status=FCMHistoryBase.Status.PENDING,
                 )
             )
         return entries
 
+    def get_devices(self) -> QuerySet:
+        """Build the queryset of all enabled devices this message is addressed to
+
+        Each device is annotated with ``fanout_topic_id``, the id of the topic
+        the device is addressed by. When sending to multiple topics a device
+        that subscribes to more than one of them is returned once per topic.
+
+        Only ``id``, ``registration_id``, ``user_id`` and ``platform`` are loaded.
+
+        :returns: QuerySet of devices, ordered by primary key
+        """
+        topic_names = self._topics or ["default"]
+        self.resolve_topics(topic_names)
+
+        devices = FCMDevice.objects.filter(disabled_at__isnull=True)
+        if self._users or self._devices:
+            # Only the first topic is used to filter the devices of users or explicitly set devices
+            topic_obj = self.get_topic(topic_names[0])
+            if self._users:
+                devices = devices.filter(user_id__in=self._users, topics=topic_obj)
+            else:
+                devices = devices.filter(registration_id__in=self._devices, topics=topic_obj)
+            devices = devices.annotate(fanout_topic_id=Value(topic_obj.pk))
+        elif self._topics:
+            devices = devices.filter(topics__name__in=self._topics).annotate(fanout_topic_id=F("topics"))
+        else:
+            devices = devices.none()
+        return devices.only("id", "registration_id", "user_id", "platform").order_by("pk")
+
+    def get_cached_devices(self) -> Optional[list[FCMDevice]]:
+        """Resolve the addressed devices from the device cache, see ``firebase_push.device_cache``
+
+        Returns the same devices as ``get_devices()`` as a list.
+
+        :returns: List of devices, ordered by primary key, or ``None`` if the
+            cache is disabled or can not resolve the addressed devices
+        """
+        if not device_cache.enabled() or self._devices:
+            return None
+        if self._users and not device_cache.caches_users(self._users):
+            return None
+        topic_names = self._topics or ["default"]
+        self.resolve_topics(topic_names)
+
+        addressed: list[Tuple[device_cache.CachedDevice, int]] = []
+        if self._users:
+            # Only the first topic is used to filter the devices of users
+            topic_id = self.get_topic(topic_names[0]).pk
+            for devices in device_cache.get_user_devices(dict.fromkeys(self._users)).values():
+                addressed.extend((device, topic_id) for device in devices if topic_id in device.topic_ids)
+        elif self._topics:
+            topics = {name: self._topic_cache[name].pk for name in topic_names if name in self._topic_cache}
+            by_topic = device_cache.get_topic_devices(topics)
+            if by_topic is None:
+                return None
+            for name, devices in by_topic.items():
+                addressed.extend((device, topics[name]) for device in devices)
+
+        result: list[FCMDevice] = []
+        for device, topic_id in sorted(addressed, key=lambda item: item[0].id):
+            obj = FCMDevice(
+                id=device.id, registration_id=device.registration_id, user_id=device.user_id, platform=device.platform
+            )
+            obj.fanout_topic_id = topic_id
+            result.append(obj)
+        return result
+
+    def get_shards(self, shard_size: int) -> list[Tuple[int, int]]:
+        """Partition the addressed devices into primary key ranges
+
+        The ranges are evenly spaced between the lowest and the highest
+        primary key of the addressed devices, so each shard contains about
+        ``shard_size`` devices if the primary keys are dense.
+
+        :param shard_size: Targeted number of devices per shard
+        :returns: List of inclusive ``(first_pk, last_pk)`` ranges
+        """
+        stats = self.get_devices().aggregate(count=Count("pk"), first=Min("pk"), last=Max("pk"))
+        if stats["count"] == 0:
+            return []
+
+        num_shards = ceil(stats["count"] / shard_size)
+        step = ceil((stats["last"] - stats["first"] + 1) / num_shards)
+        return [
+            (first_pk, min(first_pk + step - 1, stats["last"]))
+            for first_pk in range(stats["first"], stats["last"] + 1, step)
+        ]
+
+    def get_exact_shards(self, shard_size: int) -> list[Tuple[int, int, int]]:
+        """Partition the addressed devices into primary key ranges of at most ``shard_size`` messages
+
+        Unlike ``get_shards()`` the ranges follow the primary keys of the
+        addressed devices, which are read page by page (keyset pagination), so
+        this runs one query per shard. A device addressed by multiple topics
+        is one message per topic and never split between shards, so only a
+        device addressed by more than ``shard_size`` topics exceeds the size.
+
+        :param shard_size: Maximum number of messages per shard
+        :returns: List of inclusive ``(first_pk, last_pk, count)`` ranges with their number of messages
+        """
+        devices = self.get_devices().values_list("pk", flat=True)
+        shards: list[Tuple[int, int, int]] = []
+        last_pk: Optional[int] = None
+        while True:
+            page = devices if last_pk is None else devices.filter(pk__gt=last_pk)
+            pks = list(page[: shard_size + 1])
+            if not pks:
+                return shards
+            if len(pks) <= shard_size:
+                shards.append((pks[0], pks[-1], len(pks)))
+                return shards
+
+            # End the shard before the device the next page starts with
+            next_pk = pks[shard_size]
+            pks = [pk for pk in pks[:shard_size] if pk != next_pk]
+            if pks:
+                shards.append((pks[0], pks[-1], len(pks)))
+            else:
+                shards.append((next_pk, next_pk, devices.filter(pk=next_pk).count()))
+            last_pk = shards[-1][1]
+
+    def fanout_batches(
+        self, batch_size: int = 500, pk_range: Optional[Tuple[int, int]] = None
+    ) -> Iterator[list[Tuple[list[FCMHistoryBase], Message]]]:
+        """Create message objects for each device we want to address in batches
+
+        Devices are streamed from the database and the history entries of a
+        batch are bulk created right before the batch is yielded, so memory
+        usage is bounded by ``batch_size`` instead of the number of addressed
+        devices. With ``FCM_HISTORY_WRITE_BEHIND`` enabled the history entries
+        are not saved, they are created after sending by ``write_history``.
+
+        This runs a constant number of queries per batch, regardless of the
+        number of addressed users, topics and devices. With
+        ``FCM_DEVICE_CACHE_TIMEOUT`` set, devices of users and topics are
+        resolved from the cache instead, see ``get_cached_devices()``.
+
+        :param batch_size: Maximum number of messages in one batch
+        :param pk_range: Optional inclusive range of device primary keys to
+            restrict the fanout to, see ``get_shards()``
+        :returns: Iterator over lists of messages to send to firebase
+        """
+        rendered, rendered_data = self.render_cached()
+        devices = self.get_cached_devices() if pk_range is None else None
+        if devices is None:
+            queryset = self.get_devices()
+            if pk_range is not None:
+                queryset = queryset.filter(pk__range=pk_range)
+            devices = queryset.iterator(chunk_size=batch_size)
+        topic_names = {topic.pk: name for name, topic in self._topic_cache.items()}
+        save_history = not write_behind()
+        compact = compact_history()
+        if compact:
+            self._save_payload(rendered_data)
+
+        batch: list[Tuple[list[FCMHistoryBase], Message]] = []
+        start = time.perf_counter()
+        for device in devices:
+            # Only the token differs between devices, the shallow copy shares the
+            # rendered platform configs which are not modified after rendering.
+            msg = copy(rendered)
+            msg.token = device.registration_id
+            history = self.create_history_entries(
+                msg,
+                device=device,
+                topic=topic_names[device.fanout_topic_id],
+                message_data=(
+                    {"token": device.registration_id} if compact else dict(rendered_data, token=device.registration_id)
+                ),
+            )
+            batch.append((history, msg))
+            if len(batch) >= batch_size:
+                if save_history:
+                    self._save_history(batch)
+                metrics.timing("fanout", time.perf_counter() - start)
+                yield batch
+                batch = []
+                start = time.perf_counter()
+        if batch:
+            if save_history:
+                self._save_history(batch)
+            metrics.timing("fanout", time.perf_counter() - start)
+            yield batch
+
     def fanout(self) -> list[Tuple[list[FCMHistoryBase], Message]]:
         """Create message object for each device we want to address
 
+        This keeps all messages in memory, use ``fanout_batches()`` for large
+        numbers of devices.
+
         :returns: List of messages to send to firebase
         """
-        rendered = self.render()
-        topic = self._topics[0] if len(self._topics) > 0 else "default"
-        topic_obj = FCMTopic.objects.get(name=topic)
+        messages: list[Tuple[list[FCMHistoryBase], Message]] = []
+        for batch in self.fanout_batches():
+            messages.extend(batch)
+        return messages
+
+    def uses_server_side_topics(self) -> bool:
+        """Whether this message is sent as one firebase topic message per topic
+
+        This is the case when ``FCM_SERVER_SIDE_TOPICS`` is enabled and the
+        message is only addressed to topics.
+        """
+        if not getattr(settings, "FCM_SERVER_SIDE_TOPICS", False):
+            return False
+        return bool(self._topics) and not self._users and not self._devices
+
+    def fanout_topics(self) -> list[Tuple[list[FCMHistoryBase], Message]]:
+        """Create one firebase topic message for each topic we want to address
+
+        Firebase delivers topic messages to all devices subscribed to the topic,
+        so only one aggregate history entry is created per topic. The
+        subscriptions have to be kept in sync with firebase, see
+        ``firebase_push.subscriptions``.
+
+        :returns: List of messages to send to firebase
+        """
+        rendered, rendered_data = self.render_cached()
+        self.resolve_topics(self._topics)
+        compact = compact_history()
+        if compact:
+            self._save_payload(rendered_data)
 
         messages: list[Tuple[list[FCMHistoryBase], Message]] = []
-        if self._users:
-            for user in self.users:
-                for device in FCMDevice.objects.filter(user=user, disabled_at__isnull=True, topics=topic_obj):
-                    msg = copy(rendered)
-                    msg.token = device.registration_id
-                    history = self.create_history_entries(msg, device=device, user=user, topic=topic)
-                    messages.append((history, msg))
-        elif self._topics:
-            for topic in self._topics:
-                for device in FCMDevice.objects.filter(topic__name=topic, disabled_at__isnull=True):
-                    msg = copy(rendered)
-                    msg.token = device.registration_id
-                    history = self.create_history_entries(msg, device=device, topic=topic)
-                    messages.append((history, msg))
-        elif self._devices:
-            for device in self._devices:
-                if device.disabled_at is not None:
-                    continue
-                if not device.topics.contains(topic_obj):
-                    continue
-                msg = copy(rendered)
-                msg.token = device
-                history = self.create_history_entries(msg, device=device, topic=topic)
-                messages.append((history, msg))
+        for topic in self._topics:
+            msg = copy(rendered)
+            msg.topic = topic
+            message_data = {"topic": topic} if compact else dict(rendered_data, topic=topic)
+            history = self.create_history_entries(msg, topic=topic, message_data=message_data)
+            messages.append((history, msg))
+        if not write_behind():
+            self._save_history(messages)
+        return messages
+
+    def _save_payload(self, data: dict[str, Any]):
+        # Shards of a message may save the payload concurrently
+        FCMMessagePayload.objects.bulk_create(
+            [FCMMessagePayload(message_id=self.uuid, data=data)], ignore_conflicts=True
+        )
 
+    def _save_history(self, messages: list[Tuple[list[FCMHistoryBase], Message]]):
         # extract all history items and flatten the arrays
         history: list[FCMHistory] = []
         for history_items, _ in messages:
             history.extend(history_items)
         FCMHistory.objects.bulk_create(history)
 
-        return messages
-
-    def send(self, sync=False):
+    def send(self, sync=False, at: Optional[datetime] = None, rate: Optional[int] = None):
         """Send a fully configured message in the background
 
+        With ``at`` or ``rate`` set the message is stored as a campaign that is
+        sent by the ``dispatch_campaigns`` task, see ``firebase_push.campaigns``.
+
+        :param sync: Send the message in this process
+        :param at: Time to start sending the message
+        :param rate: Maximum number of messages sent per minute
+        :returns: Result of ``send_message`` when sending synchronously, the
+            celery result when sending in the background or the ``FCMCampaign``
+
         Raises:
             <User>.DoesNotExist: If a user is configured and does not exist anymore
             FCMDevice.DoesNotExist: If a device has been configured that does not exist anymore
@@ -305,21 +571,16 @@ class PushMessageBase:
 
         topic = self._topics[0] if len(self._topics) > 0 else "default"
 
-        serialized = json.dumps(self.serialize())
         if self._users:
-            if not self.users.exists():
+            # Users with cached devices exist, only check the database otherwise
+            cached = device_cache.get_user_devices(self._users) if device_cache.caches_users(self._users) else {}
+            if not any(cached.values()) and not self.users.exists():
                 UserModel = FCMDevice._meta.get_field("user").related_model
                 raise UserModel.DoesNotExist
-            if sync:
-                return send_message(serialized)
-            return send_message.delay(serialized)
+            return self._dispatch(sync, at, rate)
         if self._topics:
-            for topic in self._topics:
-                if not FCMTopic.objects.filter(name=topic).exists():
-                    FCMTopic.objects.create(name=topic)
-            if sync:
-                return send_message(serialized)
-            return send_message.delay(serialized)
+            self._topic_cache.update(topics.ensure_topics(self._topics))
+            return self._dispatch(sync, at, rate)
         if self._devices:
             if not FCMDevice.objects.filter(registration_id__in=self._devices).exists():
                 raise FCMDevice.DoesNotExist
@@ -327,11 +588,44 @@ class PushMessageBase:
                 registration_id__in=self._devices, disabled_at__isnull=True, topics__name=topic
             ).exists():
                 raise AttributeError("No enabled devices subscribing to the topic found")
-            if sync:
-                return send_message(serialized)
-            return send_message.delay(serialized)
+            return self._dispatch(sync, at, rate)
         raise ValueError("No target to send message to, either set a user, device or topic")
 
+    def _dispatch(self, sync: bool, at: Optional[datetime], rate: Optional[int]):
+        if at is not None or rate is not None:
+            from firebase_push.campaigns import schedule
+
+            return schedule(self, at=at, rate=rate)
+        if sync:
+            return send_message(self.to_json())
+        return send_message.delay(self.to_json())
+
+    def render_cached(self) -> Tuple[Message, dict[str, Any]]:
+        """Render the message once and cache the result
+
+        :returns: Firebase Message object without receiving device token set
+            and its serialized data
+        """
+        if self._rendered is None:
+            with metrics.timer("render"):
+                rendered = self.render()
+
+            # A message can only be serialized with a target set
+            template = copy(rendered)
+            template.token = "token"
+            data = json.loads(str(template))
+            del data["token"]
+
+            self._rendered = (rendered, data)
+        return self._rendered
+
+    def get_ttl(self) -> Optional[timedelta]:
+        """Time until ``expiration``, which may be naive (local time) or timezone aware"""
+        if self.expiration is None:
+            return None
+        now = timezone.now() if timezone.is_aware(self.expiration) else datetime.now()
+        return self.expiration - now
+
     def render(self) -> Message:
         """Render a message into firebase objects
 
@@ -364,8 +658,7 @@ class PushMessageBase:
         android = AndroidConfig(
             self.collapse_id, "high" if self.is_priority else "normal", notification=android_notification
         )
-        if self.expiration:
-            android.ttl = self.expiration - datetime.now()
+        android.ttl = self.get_ttl()
 
         # Web specific
         actions: list[WebpushNotificationAction] = []
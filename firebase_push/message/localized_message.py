@@ -1,5 +1,4 @@
 import re
-from datetime import datetime
 from typing import Any, Optional, Sequence
 
 from django.conf import settings
@@ -134,8 +133,7 @@ class LocalizedPushMessage(PushMessageBase):
         # Android specfic code
         android = msg.android
         if android is None:
-            ttl = self.expiration - datetime.now()
-            android = AndroidConfig(self.collapse_id, "high" if self.is_priority else "normal", ttl)
+            android = AndroidConfig(self.collapse_id, "high" if self.is_priority else "normal", self.get_ttl())
             msg.android = android
 
         android_notification = AndroidNotification(
@@ -0,0 +1,145 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+class MetricsBackend:
+    """Receives timings and counters from the send pipeline
+
+    The default implementation discards everything, subclass it and point
+    ``FCM_METRICS_BACKEND`` to the subclass or call ``set_backend()`` to
+    collect metrics.
+
+    Emitted timings (seconds):
+
+    - ``render``: rendering a message
+    - ``fanout``: resolving devices and creating history entries, per batch
+    - ``send``: transmitting a batch to firebase, tagged with ``engine``
+    - ``history_flush``: writing history status updates, per flush
+
+    Emitted counters, tagged with ``topic`` and ``platform``:
+
+    - ``sent``, ``failed``, ``unregistered``
+    """
+
+    def timing(self, name: str, seconds: float, tags: Optional[dict[str, str]] = None):
+        pass
+
+    def increment(self, name: str, value: int = 1, tags: Optional[dict[str, str]] = None):
+        pass
+
+
+class StatsdBackend(MetricsBackend):
+    """Sends metrics to statsd, requires the ``statsd`` package
+
+    Configure with ``FCM_STATSD_HOST``, ``FCM_STATSD_PORT`` and
+    ``FCM_STATSD_PREFIX``. Tag values are appended to the metric name as
+    statsd has no notion of tags.
+    """
+
+    def __init__(self) -> None:
+        try:
+            from statsd import StatsClient
+        except ImportError:
+            raise ImproperlyConfigured("The statsd metrics backend requires the statsd package")
+
+        self.client = StatsClient(
+            getattr(settings, "FCM_STATSD_HOST", "localhost"),
+            getattr(settings, "FCM_STATSD_PORT", 8125),
+            prefix=getattr(settings, "FCM_STATSD_PREFIX", "firebase_push"),
+        )
+
+    def name(self, name: str, tags: Optional[dict[str, str]]) -> str:
+        if not tags:
+            return name
+        return ".".join([name] + [str(value).replace(".", "_") for _, value in sorted(tags.items())])
+
+    def timing(self, name: str, seconds: float, tags: Optional[dict[str, str]] = None):
+        self.client.timing(self.name(name, tags), seconds * 1000)
+
+    def increment(self, name: str, value: int = 1, tags: Optional[dict[str, str]] = None):
+        self.client.incr(self.name(name, tags), value)
+
+
+class PrometheusBackend(MetricsBackend):
+    """Records metrics with ``prometheus_client``, requires the ``prometheus_client`` package
+
+    Timings are recorded as histograms named ``firebase_push_<name>_seconds``,
+    counters as ``firebase_push_<name>_total``. Expose them with the
+    exporter you already use for your workers.
+    """
+
+    def __init__(self) -> None:
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImproperlyConfigured("The prometheus metrics backend requires the prometheus_client package")
+
+        self.prometheus_client = prometheus_client
+        self.metrics: dict[tuple[str, tuple[str, ...]], Any] = {}
+
+    def get_metric(self, kind: Any, name: str, tags: Optional[dict[str, str]]) -> Any:
+        labels = tuple(sorted(tags or {}))
+        metric = self.metrics.get((name, labels))
+        if metric is None:
+            metric = kind(f"firebase_push_{name}", f"firebase_push {name}", labels)
+            self.metrics[(name, labels)] = metric
+        if labels:
+            return metric.labels(**tags)
+        return metric
+
+    def timing(self, name: str, seconds: float, tags: Optional[dict[str, str]] = None):
+        self.get_metric(self.prometheus_client.Histogram, f"{name}_seconds", tags).observe(seconds)
+
+    def increment(self, name: str, value: int = 1, tags: Optional[dict[str, str]] = None):
+        self.get_metric(self.prometheus_client.Counter, name, tags).inc(value)
+
+
+BACKENDS = {
+    "statsd": "firebase_push.metrics.StatsdBackend",
+    "prometheus": "firebase_push.metrics.PrometheusBackend",
+}
+
+_backend: Optional[MetricsBackend] = None
+
+
+def get_backend() -> MetricsBackend:
+    """
+    Return the metrics backend configured with ``FCM_METRICS_BACKEND``.
+
+    The setting is either one of the names in ``BACKENDS`` or the dotted path
+    to a ``MetricsBackend`` subclass, by default metrics are discarded.
+    """
+    global _backend
+    if _backend is None:
+        name = getattr(settings, "FCM_METRICS_BACKEND", None)
+        _backend = import_string(BACKENDS.get(name, name))() if name else MetricsBackend()
+    return _backend
+
+
+def set_backend(backend: Optional[MetricsBackend]):
+    """Replace the metrics backend, ``None`` reloads it from the settings on next use"""
+    global _backend
+    _backend = backend
+
+
+def timing(name: str, seconds: float, **tags: str):
+    get_backend().timing(name, seconds, tags or None)
+
+
+def increment(name: str, value: int = 1, **tags: str):
+    get_backend().increment(name, value, tags or None)
+
+
+@contextmanager
+def timer(name: str, **tags: str) -> Iterator[None]:
+    """Context manager that emits the time spent in its body as a timing"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, time.perf_counter() - start, **tags)
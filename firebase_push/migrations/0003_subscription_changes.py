@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("firebase_push", "0002_default_topic"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FCMSubscriptionChange",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("registration_id", models.CharField(max_length=255)),
+                (
+                    "action",
+                    models.CharField(
+                        choices=[("subscribe", "Subscribe"), ("unsubscribe", "Unsubscribe")], max_length=12
+                    ),
+                ),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "topic",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="+", to="firebase_push.fcmtopic"
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("firebase_push", "0003_subscription_changes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FCMMessagePayload",
+            fields=[
+                ("message_id", models.UUIDField(primary_key=True, serialize=False)),
+                ("data", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
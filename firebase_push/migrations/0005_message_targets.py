@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("firebase_push", "0004_message_payload"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FCMMessageTargets",
+            fields=[
+                ("message_id", models.UUIDField(primary_key=True, serialize=False)),
+                ("data", models.BinaryField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("firebase_push", "0005_message_targets"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FCMCampaign",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("message_id", models.UUIDField(unique=True)),
+                ("message", models.TextField(help_text="Serialized message, see PushMessageBase.to_json()")),
+                ("send_at", models.DateTimeField()),
+                (
+                    "rate",
+                    models.PositiveIntegerField(
+                        blank=True, help_text="Maximum number of messages per minute", null=True
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("scheduled", "Scheduled"),
+                            ("sending", "Sending"),
+                            ("paused", "Paused"),
+                            ("done", "Done"),
+                        ],
+                        default="scheduled",
+                        max_length=9,
+                    ),
+                ),
+                ("shards", models.JSONField(blank=True, default=list)),
+                ("released_shards", models.PositiveIntegerField(default=0)),
+                ("finished_shards", models.PositiveIntegerField(default=0)),
+                ("devices", models.PositiveIntegerField(default=0)),
+                ("sent", models.PositiveIntegerField(default=0)),
+                ("failed", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "indexes": [models.Index(fields=["status", "send_at"], name="firebase_pu_status_389a73_idx")],
+            },
+        ),
+    ]
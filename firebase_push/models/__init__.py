@@ -1,6 +1,17 @@
+from .campaigns import FCMCampaign
 from .devices import FCMDeviceBase
 from .history import FCMHistoryBase
+from .payloads import FCMMessagePayload, FCMMessageTargets
+from .subscriptions import FCMSubscriptionChange
 from .topics import FCMTopic
 
 
-__all__ = ["FCMDeviceBase", "FCMHistoryBase", "FCMTopic"]
+__all__ = [
+    "FCMCampaign",
+    "FCMDeviceBase",
+    "FCMHistoryBase",
+    "FCMMessagePayload",
+    "FCMMessageTargets",
+    "FCMSubscriptionChange",
+    "FCMTopic",
+]
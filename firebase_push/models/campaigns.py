@@ -0,0 +1,38 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class FCMCampaign(models.Model):
+    """Message that is sent at a later time and/or rate limited, see ``firebase_push.campaigns``"""
+
+    class Status(models.TextChoices):
+        SCHEDULED = "scheduled", _("Scheduled")
+        SENDING = "sending", _("Sending")
+        PAUSED = "paused", _("Paused")
+        DONE = "done", _("Done")
+
+    message_id = models.UUIDField(unique=True)
+    message = models.TextField(help_text=_("Serialized message, see PushMessageBase.to_json()"))
+    send_at = models.DateTimeField()
+    rate = models.PositiveIntegerField(null=True, blank=True, help_text=_("Maximum number of messages per minute"))
+    status = models.CharField(choices=Status.choices, default=Status.SCHEDULED, max_length=9, blank=False, null=False)
+
+    # Inclusive device primary key ranges and their number of messages, planned when sending starts
+    shards = models.JSONField(default=list, blank=True)
+    released_shards = models.PositiveIntegerField(default=0)
+    finished_shards = models.PositiveIntegerField(default=0)
+    devices = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # dispatch_campaigns filters by status and send_at
+            models.Index(fields=["status", "send_at"]),
+        ]
+
+    def __str__(self):
+        return str(self.message_id)
@@ -31,3 +31,7 @@ class FCMDeviceBase(models.Model):
 
     class Meta:
         abstract = True
+        indexes = [
+            # age_devices and cleanup_devices filter by disabled_at and updated_at
+            models.Index(fields=["disabled_at", "updated_at"]),
+        ]
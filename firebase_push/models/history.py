@@ -9,10 +9,10 @@ class FCMHistoryBase(models.Model):
         SENT = "sent", _("Sent")
         FAILED = "failed", _("Failed")
 
-    message_data = models.JSONField()
+    message_data = models.JSONField(default=dict, blank=True)
     message_id = models.UUIDField()
     device = models.ForeignKey(settings.FCM_DEVICE_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=False, blank=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
     topic = models.ForeignKey("firebase_push.FCMTopic", on_delete=models.SET_NULL, blank=True, null=True)
     status = models.CharField(choices=Status.choices, default=Status.PENDING, max_length=8, blank=False, null=False)
     error_message = models.TextField(default="", blank=True, null=False)
@@ -20,5 +20,26 @@ class FCMHistoryBase(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    @property
+    def payload(self) -> dict:
+        """Data that was sent to firebase
+
+        With ``FCM_COMPACT_HISTORY`` enabled ``message_data`` only contains the
+        target of the message and the rest is stored once per message in
+        ``FCMMessagePayload``, this merges both.
+        """
+        from .payloads import FCMMessagePayload
+
+        data = FCMMessagePayload.objects.filter(message_id=self.message_id).values_list("data", flat=True).first()
+        if data is None:
+            return self.message_data
+        return dict(data, **self.message_data)
+
     class Meta:
         abstract = True
+        indexes = [
+            # cleanup_history and the admin filter by status and order by updated_at
+            models.Index(fields=["status", "updated_at"]),
+            models.Index(fields=["updated_at"]),
+            models.Index(fields=["message_id"]),
+        ]
@@ -0,0 +1,35 @@
+from django.db import models
+
+
+class FCMMessagePayload(models.Model):
+    """Data sent to firebase that is shared by all history entries of a message
+
+    Only recorded with ``FCM_COMPACT_HISTORY`` enabled, the history entries
+    then only store the target of the message, see ``FCMHistoryBase.payload``.
+    """
+
+    message_id = models.UUIDField(primary_key=True)
+    data = models.JSONField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.message_id)
+
+
+class FCMMessageTargets(models.Model):
+    """Users and devices a message is addressed to, stored instead of in the celery task
+
+    Only recorded for messages addressed to more than
+    ``FCM_MAX_INLINE_TARGETS`` users and devices, see
+    ``PushMessageBase.to_json()``. ``data`` is the zlib compressed JSON of the
+    targets.
+    """
+
+    message_id = models.UUIDField(primary_key=True)
+    data = models.BinaryField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.message_id)
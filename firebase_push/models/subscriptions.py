@@ -0,0 +1,20 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class FCMSubscriptionChange(models.Model):
+    """Outbox of topic subscription changes that still have to be pushed to firebase"""
+
+    class Action(models.TextChoices):
+        SUBSCRIBE = "subscribe", _("Subscribe")
+        UNSUBSCRIBE = "unsubscribe", _("Unsubscribe")
+
+    registration_id = models.CharField(max_length=255)
+    topic = models.ForeignKey("firebase_push.FCMTopic", on_delete=models.CASCADE, related_name="+")
+    action = models.CharField(choices=Action.choices, max_length=12, blank=False, null=False)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.action} <{self.registration_id}> to {self.topic_id}"
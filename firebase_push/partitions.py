@@ -0,0 +1,98 @@
+"""
+Helpers for a history table that is partitioned by month on ``created_at``
+
+Only PostgreSQL supports this. Dropping a partition removes all history
+entries of a month at once instead of deleting them row by row. The table
+has to be created as a partitioned table, see the README.
+"""
+
+import re
+from datetime import date
+from typing import Optional, Type
+
+from django.db import connection, models
+
+
+def is_partitioned(model: Type[models.Model]) -> bool:
+    """Whether the table of the model is a partitioned PostgreSQL table"""
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+            [model._meta.db_table],
+        )
+        return cursor.fetchone() is not None
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(model: Type[models.Model], month: date) -> str:
+    return f"{model._meta.db_table}_{month:%Y%m}"
+
+
+def list_partitions(model: Type[models.Model]) -> dict[str, date]:
+    """Return the monthly partitions of the table of the model
+
+    :returns: Dictionary of partition names and the first day of the month they hold
+    """
+    pattern = re.compile(re.escape(model._meta.db_table) + r"_(\d{4})(\d{2})$")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s",
+            [model._meta.db_table],
+        )
+        names = [name for name, in cursor.fetchall()]
+
+    partitions = {}
+    for name in names:
+        if match := pattern.match(name):
+            partitions[name] = date(int(match.group(1)), int(match.group(2)), 1)
+    return partitions
+
+
+def create_partitions(model: Type[models.Model], months_ahead: int = 2, start: Optional[date] = None) -> list[str]:
+    """Create the monthly partitions from ``start`` (default: this month) to ``months_ahead`` months in the future
+
+    Existing partitions are skipped.
+
+    :returns: Names of the created partitions
+    """
+    month = (start or date.today()).replace(day=1)
+    existing = list_partitions(model)
+    quote = connection.ops.quote_name
+
+    created = []
+    with connection.cursor() as cursor:
+        for _ in range(months_ahead + 1):
+            name = partition_name(model, month)
+            if name not in existing:
+                cursor.execute(
+                    f"CREATE TABLE {quote(name)} PARTITION OF {quote(model._meta.db_table)} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+                )
+                created.append(name)
+            month = add_months(month, 1)
+    return created
+
+
+def drop_partitions(model: Type[models.Model], before: date) -> list[str]:
+    """Detach and drop all monthly partitions that only hold entries created before ``before``
+
+    :returns: Names of the dropped partitions
+    """
+    quote = connection.ops.quote_name
+    dropped = []
+    with connection.cursor() as cursor:
+        for name, month in sorted(list_partitions(model).items(), key=lambda item: item[1]):
+            if add_months(month, 1) > before:
+                continue
+            cursor.execute(f"ALTER TABLE {quote(model._meta.db_table)} DETACH PARTITION {quote(name)}")
+            cursor.execute(f"DROP TABLE {quote(name)}")
+            dropped.append(name)
+    return dropped
@@ -0,0 +1,55 @@
+"""
+Rate limits shared by all processes through the django cache
+
+Django caches only offer atomic increments, so the limit is enforced per
+time window: the tokens of a window are counted with ``incr()`` under a key
+for the window and the bucket is full again when the next window starts.
+"""
+
+import time
+
+from firebase_push.utils import cache_incr, get_cache
+
+
+class RateLimiter:
+    """Allows up to ``rate`` tokens per ``period`` seconds across all processes"""
+
+    def __init__(self, key: str, rate: int, period: int = 60) -> None:
+        self.key = key
+        self.rate = rate
+        self.period = period
+
+    def _window_key(self) -> str:
+        return f"{self.key}:{int(time.time() // self.period)}"
+
+    def acquire(self, tokens: int = 1) -> bool:
+        """Take tokens from the current window
+
+        :returns: ``False`` if the window does not have enough tokens left,
+            no tokens are taken then
+        """
+        used = cache_incr(self._window_key(), tokens, timeout=self.period * 2)
+        if used > self.rate:
+            self.release(tokens)
+            return False
+        return True
+
+    def release(self, tokens: int = 1):
+        """Return tokens that were taken but not used to the current window"""
+        try:
+            get_cache().decr(self._window_key(), tokens)
+        except ValueError:
+            # The window has ended or the key was evicted
+            pass
+
+
+def acquire_all(limiters: list[RateLimiter], tokens: int) -> bool:
+    """Take tokens from all limiters or from none of them"""
+    acquired: list[RateLimiter] = []
+    for limiter in limiters:
+        if not limiter.acquire(tokens):
+            for taken in acquired:
+                taken.release(tokens)
+            return False
+        acquired.append(limiter)
+    return True
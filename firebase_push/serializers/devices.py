@@ -1,12 +1,20 @@
+from typing import Any, Collection, Optional, Tuple
+
 from django.conf import settings
+from django.db import connections
+from django.utils import timezone
 from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 
-from firebase_push.models import FCMTopic
-from firebase_push.utils import get_device_model
+from firebase_push import device_cache, heartbeat
+from firebase_push.models import FCMSubscriptionChange, FCMTopic
+from firebase_push.topics import get_topics
+from firebase_push.utils import fast_delete, get_device_model, get_history_model
 
 
 FCMDevice = get_device_model()
+FCMHistory = get_history_model()
 
 try:
     get_user = import_string(settings.FCM_FETCH_USER_FUNCTION)
@@ -14,9 +22,39 @@ except AttributeError:
     get_user = import_string("firebase_push.defaults.get_user")
 
 
+class TopicListField(serializers.ListField):
+    """List of topic names, all names are resolved with one query"""
+
+    child = serializers.CharField(max_length=255)
+    default_error_messages = {
+        "does_not_exist": _("Object with name={value} does not exist."),
+    }
+
+    def to_internal_value(self, data) -> list[FCMTopic]:
+        names = list(dict.fromkeys(super().to_internal_value(data)))
+        # Topics may have been resolved for many registrations at once
+        topics = self.context.get("topics")
+        if topics is None:
+            topics = get_topics(names)
+        for name in names:
+            if name not in topics:
+                self.fail("does_not_exist", value=name)
+        return [topics[name] for name in names]
+
+    def get_attribute(self, instance):
+        # Topics that were just registered, avoids fetching them again
+        registered = getattr(instance, "_registered_topics", None)
+        if registered is not None:
+            return registered
+        return instance.topics.all()
+
+    def to_representation(self, data) -> list[str]:
+        return [topic.name for topic in data]
+
+
 class FCMDeviceSerializer(serializers.ModelSerializer):
     registration_id = serializers.CharField(allow_blank=False, min_length=10, max_length=255)
-    topics = serializers.SlugRelatedField(many=True, slug_field="name", queryset=FCMTopic.objects.all())
+    topics = TopicListField()
 
     class Meta:
         model = FCMDevice
@@ -24,37 +62,191 @@ class FCMDeviceSerializer(serializers.ModelSerializer):
         read_only_fields = ("created_at", "updated_at", "registration_id")
 
     def create(self, validated_data):
+        return self.register(validated_data.pop("registration_id"), validated_data)
+
+    def update(self, instance, validated_data):
+        validated_data.pop("registration_id", None)
+        return self.register(instance.registration_id, validated_data, instance=instance)
+
+    def register(self, registration_id: str, validated_data: dict[str, Any], instance: Optional[FCMDevice] = None):
+        """Create or update the registration of a device, see ``register_devices()``
+
+        With ``FCM_REGISTRATION_FRESHNESS`` set, unchanged registrations are
+        answered from the cache without writing, see ``firebase_push.heartbeat``.
+        """
         user = get_user(self.context["request"])
-        try:
-            fcm_device = FCMDevice.objects.get(registration_id=validated_data["registration_id"])
+        data_fingerprint = None
+        if instance is None:
+            data_fingerprint = heartbeat.fingerprint(registration_id, user, validated_data)
+            values = heartbeat.get_fresh(registration_id, data_fingerprint)
+            if values is not None:
+                device = FCMDevice(**values)
+                device._registered_topics = validated_data.get("topics")
+                return device
 
-            # if user does not match, destroy registration and re-create
-            if fcm_device.user.id != user:
-                fcm_device.delete()
-                fcm_device = None
-        except FCMDevice.DoesNotExist:
-            # registration does not exist
-            fcm_device = None
+        instances = {registration_id: instance} if instance is not None else None
+        device, _created = register_devices(user, [(registration_id, validated_data)], instances=instances)[0]
+        if data_fingerprint is not None:
+            heartbeat.remember(registration_id, data_fingerprint, device)
+        return device
 
-        # run create normally when fcm_device does not exist
-        if fcm_device is None:
-            validated_data["user_id"] = get_user(self.context["request"])
-            return super().create(validated_data)
 
-        # run an update instead if it exists
-        return self.update(fcm_device, validated_data)
+def register_devices(
+    user: Any,
+    registrations: list[Tuple[str, dict[str, Any]]],
+    instances: Optional[dict[str, FCMDevice]] = None,
+) -> list[Tuple[FCMDevice, bool]]:
+    """Create or update device registrations of a user with one upsert
 
-    def update(self, instance, validated_data):
-        # when user does not match, destroy registration and re-create
-        user = get_user(self.context["request"])
-        if instance.user.id != user:
-            validated_data["registration_id"] = instance.registration_id
-            instance.delete()
-            return self.create(validated_data)
+    Values that were not sent are kept for existing registrations. If a
+    registration is recorded for a different user its history is detached and
+    it is replaced completely, including its topics, so the new user does not
+    receive messages for the old user. Registering re-enables disabled devices.
+
+    This runs a constant number of queries, regardless of the number of
+    registrations and topics. Like ``bulk_create`` no ``save()`` is called and
+    no signals are sent, the device cache is invalidated explicitly.
+
+    :param user: Primary key of the user the devices belong to
+    :param registrations: List of registration ids and validated data of ``FCMDeviceSerializer``,
+        registration ids must be unique
+    :param instances: Existing devices by registration id, fetched if not set
+    :returns: List of devices and whether they were created
+    """
+    if instances is None:
+        registration_ids = [registration_id for registration_id, _ in registrations]
+        instances = FCMDevice.objects.in_bulk(registration_ids, field_name="registration_id")
+    now = timezone.now()
+    fields = [field for field in FCMDevice._meta.concrete_fields if field.name not in ("id", "registration_id")]
+
+    devices: list[FCMDevice] = []
+    topics: list[Optional[list[FCMTopic]]] = []
+    replaced: list[int] = []
+    previous_users = {user}
+    for registration_id, validated_data in registrations:
+        data = dict(validated_data)
+        device_topics = data.pop("topics", None)
+        instance = instances.get(registration_id)
+
+        values: dict[str, Any] = {}
+        if instance is not None and instance.user_id != user:
+            replaced.append(instance.pk)
+            previous_users.add(instance.user_id)
+            if device_topics is None:
+                device_topics = []
+        elif instance is not None:
+            values = {field.attname: getattr(instance, field.attname) for field in fields}
+        values.update(data)
+        values.update(registration_id=registration_id, user_id=user, disabled_at=None, updated_at=now)
+        values.setdefault("created_at", now)
+        devices.append(FCMDevice(**values))
+        topics.append(device_topics)
+
+    if replaced:
+        FCMHistory.objects.filter(device_id__in=replaced).update(device=None)
+
+    unique_fields = None
+    if connections[FCMDevice.objects.db].features.supports_update_conflicts_with_target:
+        unique_fields = ["registration_id"]
+    FCMDevice.objects.bulk_create(
+        devices, update_conflicts=True, unique_fields=unique_fields, update_fields=[field.name for field in fields]
+    )
+
+    # Not all databases return the primary key of upserted rows
+    missing = {device.registration_id: device for device in devices if device.pk is None}
+    for registration_id, instance in instances.items():
+        if registration_id in missing:
+            missing.pop(registration_id).pk = instance.pk
+    if missing:
+        for registration_id, pk in FCMDevice.objects.filter(registration_id__in=missing).values_list(
+            "registration_id", "pk"
+        ):
+            missing[registration_id].pk = pk
+
+    # Disabled devices were unsubscribed from their topics on firebase, see ``age_devices``
+    enabled = {
+        device.pk
+        for device in devices
+        if device.registration_id in instances and instances[device.registration_id].disabled_at is not None
+    }
+    changes = []
+    for device, device_topics in zip(devices, topics):
+        if device_topics is not None:
+            changes.append((device, device_topics, device.registration_id not in instances))
+            device._registered_topics = device_topics
+    sync_topics(changes, enabled=enabled)
+    kept = enabled - {device.pk for device, _topics, _created in changes}
+    if kept and getattr(settings, "FCM_SERVER_SIDE_TOPICS", False):
+        # Re-enabled devices keeping their topics
+        subscriptions = FCMDevice.objects.filter(pk__in=kept, topics__isnull=False)
+        FCMSubscriptionChange.objects.bulk_create(
+            FCMSubscriptionChange(
+                registration_id=registration_id, topic_id=topic_id, action=FCMSubscriptionChange.Action.SUBSCRIBE
+            )
+            for registration_id, topic_id in subscriptions.values_list("registration_id", "topics")
+        )
+    # Remembered registrations of these devices are outdated, see ``firebase_push.heartbeat``
+    heartbeat.forget([device.registration_id for device in devices])
+    if device_cache.enabled():
+        device_cache.invalidate(previous_users)
+    return [(device, device.registration_id not in instances) for device in devices]
+
+
+def sync_topics(changes: list[Tuple[FCMDevice, list[FCMTopic], bool]], enabled: Collection[int] = ()):
+    """Replace the topics of devices, only changed subscriptions are written
+
+    The through table is written directly, so no ``m2m_changed`` signals are
+    sent. Subscription changes are recorded explicitly when
+    ``FCM_SERVER_SIDE_TOPICS`` is enabled.
+
+    :param changes: List of devices, their topics and whether they were just created
+    :param enabled: Primary keys of re-enabled devices, they are subscribed to all their topics again
+    """
+    field = FCMDevice._meta.get_field("topics")
+    through = field.remote_field.through
+    device_field = field.m2m_field_name() + "_id"
+    topic_field = field.m2m_reverse_field_name() + "_id"
+
+    current: dict[int, dict[int, int]] = {}
+    existing = [device.pk for device, _topics, created in changes if not created]
+    if existing:
+        rows = through.objects.filter(**{f"{device_field}__in": existing})
+        for row_id, device_id, topic_id in rows.values_list("pk", device_field, topic_field):
+            current.setdefault(device_id, {})[topic_id] = row_id
 
-        # user matches, make sure to add the user id to validated_data
-        validated_data["user_id"] = user
+    removed: list[int] = []
+    added = []
+    outbox: list[FCMSubscriptionChange] = []
+    for device, topics, created in changes:
+        subscribed = current.get(device.pk, {})
+        wanted = {topic.pk for topic in topics}
+        # Re-enabled devices are not subscribed on firebase to any topic
+        reenabled = device.pk in enabled
+        for topic_id, row_id in subscribed.items():
+            if topic_id not in wanted:
+                removed.append(row_id)
+            if topic_id not in wanted and not reenabled:
+                outbox.append(
+                    FCMSubscriptionChange(
+                        registration_id=device.registration_id,
+                        topic_id=topic_id,
+                        action=FCMSubscriptionChange.Action.UNSUBSCRIBE,
+                    )
+                )
+        for topic_id in wanted - subscribed.keys():
+            added.append(through(**{device_field: device.pk, topic_field: topic_id}))
+        for topic_id in wanted if reenabled else wanted - subscribed.keys():
+            outbox.append(
+                FCMSubscriptionChange(
+                    registration_id=device.registration_id,
+                    topic_id=topic_id,
+                    action=FCMSubscriptionChange.Action.SUBSCRIBE,
+                )
+            )
 
-        # Someone updated the device, so it is active again
-        validated_data["disabled_at"] = None
-        return super().update(instance, validated_data)
+    if removed:
+        fast_delete(through.objects.filter(pk__in=removed))
+    if added:
+        through.objects.bulk_create(added, ignore_conflicts=True)
+    if outbox and getattr(settings, "FCM_SERVER_SIDE_TOPICS", False):
+        FCMSubscriptionChange.objects.bulk_create(outbox)
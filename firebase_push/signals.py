@@ -0,0 +1,104 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+
+from firebase_push import device_cache, topics
+from firebase_push.models import FCMSubscriptionChange, FCMTopic
+from firebase_push.subscriptions import record_changes
+from firebase_push.utils import get_device_model
+
+
+FCMDevice = get_device_model()
+
+
+def topics_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Record changes of ``FCMDevice.topics`` in the subscription outbox"""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if action == "post_add":
+        change = FCMSubscriptionChange.Action.SUBSCRIBE
+    else:
+        change = FCMSubscriptionChange.Action.UNSUBSCRIBE
+
+    if reverse:
+        # Devices were added to or removed from a topic
+        devices = instance.devices.all() if pk_set is None else FCMDevice.objects.filter(pk__in=pk_set)
+        record_changes(devices.values_list("registration_id", flat=True), [instance.pk], change)
+    else:
+        topic_ids = instance.topics.values_list("pk", flat=True) if pk_set is None else pk_set
+        record_changes([instance.registration_id], topic_ids, change)
+
+
+def device_deleted(sender, instance, **kwargs):
+    """Unsubscribe deleted devices from all their topics"""
+    record_changes(
+        [instance.registration_id],
+        instance.topics.values_list("pk", flat=True),
+        FCMSubscriptionChange.Action.UNSUBSCRIBE,
+    )
+
+
+def connect():
+    """Start recording topic subscription changes, see ``firebase_push.subscriptions.push_changes()``"""
+    m2m_changed.connect(topics_changed, sender=FCMDevice.topics.through, dispatch_uid="firebase_push_topics_changed")
+    pre_delete.connect(device_deleted, sender=FCMDevice, dispatch_uid="firebase_push_device_deleted")
+
+
+def disconnect():
+    m2m_changed.disconnect(sender=FCMDevice.topics.through, dispatch_uid="firebase_push_topics_changed")
+    pre_delete.disconnect(sender=FCMDevice, dispatch_uid="firebase_push_device_deleted")
+
+
+def device_saving(sender, instance, raw, **kwargs):
+    """Remember the previous user of a device, its cache entry is invalidated as well"""
+    if instance.pk is not None and not raw:
+        instance._previous_user_id = FCMDevice.objects.filter(pk=instance.pk).values_list("user_id", flat=True).first()
+
+
+def device_changed(sender, instance, **kwargs):
+    """Invalidate the cached devices of the user of a saved or deleted device"""
+    device_cache.invalidate({instance.user_id, getattr(instance, "_previous_user_id", None)} - {None})
+
+
+def device_topics_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidate the cached devices of users whose devices changed topics"""
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        device_cache.invalidate([instance.user_id])
+    elif pk_set is None:
+        # The devices of a cleared topic are unknown after clearing
+        device_cache.invalidate_all()
+    else:
+        device_cache.invalidate(FCMDevice.objects.filter(pk__in=pk_set).values_list("user_id", flat=True).distinct())
+
+
+def connect_device_cache():
+    """Keep the device cache up to date, see ``firebase_push.device_cache``"""
+    pre_save.connect(device_saving, sender=FCMDevice, dispatch_uid="firebase_push_device_cache_saving")
+    post_save.connect(device_changed, sender=FCMDevice, dispatch_uid="firebase_push_device_cache_saved")
+    post_delete.connect(device_changed, sender=FCMDevice, dispatch_uid="firebase_push_device_cache_deleted")
+    m2m_changed.connect(
+        device_topics_changed, sender=FCMDevice.topics.through, dispatch_uid="firebase_push_device_cache_topics"
+    )
+
+
+def disconnect_device_cache():
+    pre_save.disconnect(sender=FCMDevice, dispatch_uid="firebase_push_device_cache_saving")
+    post_save.disconnect(sender=FCMDevice, dispatch_uid="firebase_push_device_cache_saved")
+    post_delete.disconnect(sender=FCMDevice, dispatch_uid="firebase_push_device_cache_deleted")
+    m2m_changed.disconnect(sender=FCMDevice.topics.through, dispatch_uid="firebase_push_device_cache_topics")
+
+
+def topic_changed(sender, **kwargs):
+    """Make all processes drop their remembered topics"""
+    topics.invalidate()
+
+
+def connect_topic_registry():
+    """Keep the remembered topics up to date, see ``firebase_push.topics``"""
+    post_save.connect(topic_changed, sender=FCMTopic, dispatch_uid="firebase_push_topic_saved")
+    post_delete.connect(topic_changed, sender=FCMTopic, dispatch_uid="firebase_push_topic_deleted")
+
+
+def disconnect_topic_registry():
+    post_save.disconnect(sender=FCMTopic, dispatch_uid="firebase_push_topic_saved")
+    post_delete.disconnect(sender=FCMTopic, dispatch_uid="firebase_push_topic_deleted")
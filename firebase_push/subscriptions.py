@@ -0,0 +1,178 @@
+from collections import Counter
+from typing import Callable, Iterable, Optional, Tuple
+
+import firebase_admin
+import requests
+from django.conf import settings
+from django.db.models import F
+from firebase_admin import App, messaging
+
+from firebase_push.engines.http import get_access_token
+from firebase_push.models import FCMSubscriptionChange, FCMTopic
+from firebase_push.utils import get_device_model
+
+
+FCMDevice = get_device_model()
+
+# Maximum number of tokens firebase accepts in one topic management call
+FCM_MAX_SUBSCRIPTION_BATCH_SIZE = 1000
+
+# Instance ID API to fetch the topic subscriptions of a registration token
+FCM_IID_INFO_URL = "https://iid.googleapis.com/iid/info/{token}"
+
+
+def _manage_topic(
+    call: Callable[..., messaging.TopicManagementResponse], tokens: list[str], topic: str, app: Optional[App]
+) -> Tuple[int, list[Tuple[str, str]]]:
+    success = 0
+    errors: list[Tuple[str, str]] = []
+    for offset in range(0, len(tokens), FCM_MAX_SUBSCRIPTION_BATCH_SIZE):
+        chunk = tokens[offset : offset + FCM_MAX_SUBSCRIPTION_BATCH_SIZE]
+        response = call(chunk, topic, app=app)
+        success += response.success_count
+        errors.extend((chunk[error.index], error.reason) for error in response.errors)
+    return success, errors
+
+
+def subscribe(tokens: list[str], topic: str, app: Optional[App] = None) -> Tuple[int, list[Tuple[str, str]]]:
+    """Subscribe registration tokens to a firebase topic
+
+    Tokens are sent in chunks of ``FCM_MAX_SUBSCRIPTION_BATCH_SIZE``.
+
+    :returns: Number of subscribed tokens and a list of ``(token, reason)``
+        tuples for the tokens that failed
+    """
+    return _manage_topic(messaging.subscribe_to_topic, tokens, topic, app)
+
+
+def unsubscribe(tokens: list[str], topic: str, app: Optional[App] = None) -> Tuple[int, list[Tuple[str, str]]]:
+    """Unsubscribe registration tokens from a firebase topic
+
+    Tokens are sent in chunks of ``FCM_MAX_SUBSCRIPTION_BATCH_SIZE``.
+
+    :returns: Number of unsubscribed tokens and a list of ``(token, reason)``
+        tuples for the tokens that failed
+    """
+    return _manage_topic(messaging.unsubscribe_from_topic, tokens, topic, app)
+
+
+def sync_topic(topic: FCMTopic, app: Optional[App] = None) -> dict[str, int]:
+    """Push the subscriptions of a topic to firebase
+
+    All enabled devices subscribing to the topic are subscribed, disabled
+    devices are unsubscribed. Firebase ignores tokens that already are in
+    the requested state, so this is safe to run repeatedly.
+
+    :returns: Number of ``subscribed``, ``unsubscribed`` and ``failed`` tokens
+    """
+    devices = FCMDevice.objects.filter(topics=topic).order_by("pk")
+    enabled = list(devices.filter(disabled_at__isnull=True).values_list("registration_id", flat=True))
+    disabled = list(devices.filter(disabled_at__isnull=False).values_list("registration_id", flat=True))
+
+    subscribed, subscribe_errors = subscribe(enabled, topic.name, app=app)
+    unsubscribed, unsubscribe_errors = unsubscribe(disabled, topic.name, app=app)
+    return dict(
+        subscribed=subscribed,
+        unsubscribed=unsubscribed,
+        failed=len(subscribe_errors) + len(unsubscribe_errors),
+    )
+
+
+def record_changes(registration_ids: Iterable[str], topic_ids: Iterable[int], action: str):
+    """Record topic subscription changes in the outbox
+
+    The changes are pushed to firebase by ``push_changes()``, so this does not
+    talk to firebase.
+
+    :param registration_ids: Tokens of the changed devices
+    :param topic_ids: Primary keys of the changed topics
+    :param action: One of ``FCMSubscriptionChange.Action``
+    """
+    topic_ids = list(topic_ids)
+    FCMSubscriptionChange.objects.bulk_create(
+        [
+            FCMSubscriptionChange(registration_id=registration_id, topic_id=topic_id, action=action)
+            for registration_id in registration_ids
+            for topic_id in topic_ids
+        ]
+    )
+
+
+def push_changes(app: Optional[App] = None, limit: Optional[int] = None) -> dict[str, int]:
+    """Push recorded topic subscription changes to firebase
+
+    Changes are coalesced, only the latest change of a token and topic is
+    sent, and sent in one call per topic and action for up to
+    ``FCM_MAX_SUBSCRIPTION_BATCH_SIZE`` tokens. Sent changes are removed from
+    the outbox, changes that firebase rejected are retried on the next run
+    until ``FCM_SUBSCRIPTION_MAX_ATTEMPTS`` is reached.
+
+    :param limit: Maximum number of outbox entries to process, defaults to
+        ``FCM_SUBSCRIPTION_SYNC_LIMIT``
+    :returns: Number of ``subscribed``, ``unsubscribed`` and ``failed`` tokens
+    """
+    if limit is None:
+        limit = getattr(settings, "FCM_SUBSCRIPTION_SYNC_LIMIT", 10000)
+    max_attempts = getattr(settings, "FCM_SUBSCRIPTION_MAX_ATTEMPTS", 5)
+
+    changes = list(FCMSubscriptionChange.objects.select_related("topic").order_by("pk")[:limit])
+    latest: dict[Tuple[int, str], FCMSubscriptionChange] = {}
+    for change in changes:
+        latest[(change.topic_id, change.registration_id)] = change
+
+    groups: dict[Tuple[str, str], list[FCMSubscriptionChange]] = {}
+    for change in latest.values():
+        groups.setdefault((change.topic.name, change.action), []).append(change)
+
+    summary = Counter(subscribed=0, unsubscribed=0, failed=0)
+    failed: set[int] = set()
+    processed: set[Tuple[int, str]] = set()
+    for (topic, action), group in groups.items():
+        tokens = [change.registration_id for change in group]
+        if action == FCMSubscriptionChange.Action.SUBSCRIBE:
+            done, errors = subscribe(tokens, topic, app=app)
+            summary["subscribed"] += done
+        else:
+            done, errors = unsubscribe(tokens, topic, app=app)
+            summary["unsubscribed"] += done
+        summary["failed"] += len(errors)
+
+        rejected = {token for token, _ in errors}
+        failed.update(change.pk for change in group if change.registration_id in rejected)
+        processed.update((change.topic_id, change.registration_id) for change in group)
+
+    # Superseded changes are removed with the latest change of their token and topic
+    FCMSubscriptionChange.objects.filter(
+        pk__in=[
+            change.pk
+            for change in changes
+            if (change.topic_id, change.registration_id) in processed and change.pk not in failed
+        ]
+    ).delete()
+    retry = FCMSubscriptionChange.objects.filter(pk__in=failed)
+    retry.filter(attempts__gte=max_attempts - 1).delete()
+    retry.update(attempts=F("attempts") + 1)
+    return dict(summary)
+
+
+def get_remote_topics(
+    registration_id: str, app: Optional[App] = None, session: Optional[requests.Session] = None
+) -> Optional[set[str]]:
+    """Fetch the names of the topics firebase has subscribed a token to
+
+    :returns: Set of topic names or ``None`` if firebase does not know the token
+    """
+    app = app or firebase_admin.get_app()
+    response = (session or requests).get(
+        FCM_IID_INFO_URL.format(token=registration_id),
+        params={"details": "true"},
+        headers={
+            "Authorization": f"Bearer {get_access_token(app)}",
+            "access_token_auth": "true",
+        },
+        timeout=getattr(settings, "FCM_SEND_TIMEOUT", 10),
+    )
+    if response.status_code in (400, 404):
+        return None
+    response.raise_for_status()
+    return set(response.json().get("rel", {}).get("topics", {}))
@@ -1,19 +1,35 @@
+from collections import Counter
 from traceback import format_exception
+from typing import TYPE_CHECKING, Any, Optional, Tuple
 
 import firebase_admin
-from celery import shared_task
+from celery import chord, group, shared_task, signature
 from django.conf import settings
+from django.core import serializers
 from firebase_admin import credentials
+from firebase_admin.messaging import Message
 from requests import HTTPError, Timeout
 
-from firebase_push.models import FCMHistoryBase
-from firebase_push.utils import get_device_model
+from firebase_push import metrics
+from firebase_push.engines import SendEngine, get_engine
+from firebase_push.history import HistoryWriter, get_history_writer
+from firebase_push.models import FCMHistoryBase, FCMTopic
+from firebase_push.subscriptions import push_changes, sync_topic
+from firebase_push.utils import get_device_model, get_history_model, raw_bulk_create
 
 
+if TYPE_CHECKING:
+    from firebase_push.message import PushMessageBase
+
 FCMDevice = get_device_model()
+FCMHistory = get_history_model()
 
 FCM_RETRY_EXCEPTIONS = (HTTPError, Timeout)
 
+# Maximum number of messages that are sent in one batch, this is the limit
+# firebase accepts in one ``send_each`` call
+FCM_MAX_BATCH_SIZE = 500
+
 
 if credentials_file := getattr(settings, "FCM_CREDENTIALS_FILE", None):
     credential = credentials.Certificate(credentials_file)
@@ -23,37 +39,222 @@ else:
 firebase = firebase_admin.initialize_app(credential=credential)
 
 
+def get_batch_size() -> int:
+    batch_size = getattr(settings, "FCM_SEND_BATCH_SIZE", FCM_MAX_BATCH_SIZE)
+    return max(1, min(batch_size, FCM_MAX_BATCH_SIZE))
+
+
+def update_history(
+    history_items: list[FCMHistoryBase], message: Message, response: Optional[str], error: Optional[Exception]
+):
+    """Update the status of history items from the result of a send operation
+
+    The history items are not saved, see ``HistoryWriter``.
+    """
+    for history in history_items:
+        if response is not None and isinstance(response, str) and error is None:
+            history.status = FCMHistoryBase.Status.SENT
+            history.error_message = response
+        else:
+            history.status = FCMHistoryBase.Status.FAILED
+            if error is not None:
+                history.error_message = "\n".join(format_exception(error))
+                history.error_message += "\n\nMessage:\n"
+                history.error_message += str(message)
+            else:
+                history.error_message = "Unknown error"
+
+
+def send_batch(
+    batch: list[Tuple[list[FCMHistoryBase], Message]], engine: SendEngine, history_writer: HistoryWriter
+) -> Counter:
+    """Send a batch of messages with the send engine and record the results
+
+    :param batch: list of history items and message tuples as returned by ``fanout()``,
+        must not contain more than ``FCM_MAX_BATCH_SIZE`` items.
+    :param engine: Engine to send the messages with
+    :param history_writer: Writer the updated history items are added to
+    :returns: Number of ``sent`` and ``failed`` messages
+    """
+    with metrics.timer("send", engine=engine.name):
+        results = engine.send([message for _, message in batch])
+
+    # Count results by topic and platform, before devices are removed
+    counts: Counter = Counter()
+    for (history_items, _), (_, error) in zip(batch, results):
+        history = history_items[0] if history_items else None
+        topic = history.topic.name if history is not None and history.topic is not None else ""
+        platform = history.device.platform if history is not None and history.device is not None else ""
+        counts[("sent" if error is None else "failed", topic, platform)] += 1
+        if isinstance(error, firebase_admin._messaging_utils.UnregisteredError):
+            counts[("unregistered", topic, platform)] += 1
+    for (name, topic, platform), value in counts.items():
+        metrics.increment(name, value, topic=topic, platform=platform)
+
+    # Remove unregistered tokens from devices
+    unregistered: list[str] = []
+    for (history_items, message), (_, error) in zip(batch, results):
+        if isinstance(error, firebase_admin._messaging_utils.UnregisteredError):
+            unregistered.append(message.token)
+            for history in history_items:
+                history.device = None
+    if unregistered:
+        FCMDevice.objects.filter(registration_id__in=unregistered).delete()
+
+    # Now update the history objects
+    summary = Counter(sent=0, failed=0)
+    for (history_items, message), (response, error) in zip(batch, results):
+        update_history(history_items, message, response, error)
+        history_writer.add(history_items)
+        summary["sent" if error is None else "failed"] += 1
+    return summary
+
+
+def send_devices(message: "PushMessageBase", pk_range: Optional[Tuple[int, int]] = None) -> dict[str, int]:
+    """Fan out a message and send it to all addressed devices in batches
+
+    :param message: Message to send
+    :param pk_range: Optional inclusive range of device primary keys to restrict sending to
+    :returns: Number of ``sent`` and ``failed`` messages
+    """
+    summary = Counter(sent=0, failed=0)
+    with get_engine(firebase) as engine, get_history_writer() as history_writer:
+        for batch in message.fanout_batches(batch_size=get_batch_size(), pk_range=pk_range):
+            summary.update(send_batch(batch, engine, history_writer))
+    return dict(summary)
+
+
+def send_topics(message: "PushMessageBase") -> dict[str, int]:
+    """Send a message as one firebase topic message per addressed topic
+
+    :param message: Message to send
+    :returns: Number of ``sent`` and ``failed`` topic messages
+    """
+    with get_engine(firebase) as engine, get_history_writer() as history_writer:
+        summary = send_batch(message.fanout_topics(), engine, history_writer)
+    return dict(summary)
+
+
+def dispatch_shards(message: str, message_id: str, shards: list[Tuple[int, int]]):
+    """Send a message by running one ``send_message_shard`` task per device shard
+
+    If ``FCM_SEND_COMPLETE_TASK`` is configured the shards are run as a chord
+    and the named task is called with the aggregated result once all shards
+    are done, this requires a celery result backend.
+    """
+    tasks = group(send_message_shard.si(message, first_pk, last_pk) for first_pk, last_pk in shards)
+    if callback := getattr(settings, "FCM_SEND_COMPLETE_TASK", None):
+        return chord(tasks)(collect_shard_results.s(message_id) | signature(callback))
+    return tasks.apply_async()
+
+
 @shared_task(autoretry_for=FCM_RETRY_EXCEPTIONS, retry_backoff=True)
 def send_message(message: str):
+    """Send a serialized message
+
+    When ``FCM_SHARD_SIZE`` is set and the message addresses more devices
+    than that, this task only plans the send and dispatches one
+    ``send_message_shard`` task per shard. Messages sent synchronously are
+    never sharded.
+
+    With ``FCM_SERVER_SIDE_TOPICS`` enabled messages that are only addressed
+    to topics are sent as firebase topic messages instead.
+    """
     from .message import PushMessageBase
 
-    message = PushMessageBase.from_json(message)
-    messages = message.fanout()
-    for history_items, message in messages:
-        error = None
-        response = None
-        try:
-            response = firebase_admin.messaging.send(message, app=firebase)
-        except firebase_admin._messaging_utils.UnregisteredError as e:
-            # Remove Token from devices
-            FCMDevice.objects.filter(registration_id=message.token).delete()
-            for history in history_items:
-                history.device = None
-            error = e
-        except Exception as e:
-            error = e
-
-        # Now update the history objects
-        for history in history_items:
-            if response is not None and isinstance(response, str) and error is None:
-                history.status = FCMHistoryBase.Status.SENT
-                history.error_message = response
-            else:
-                history.status = FCMHistoryBase.Status.FAILED
-                if error is not None:
-                    history.error_message = "\n".join(format_exception(error))
-                    history.error_message += "\n\nMessage:\n"
-                    history.error_message += str(message)
-                else:
-                    history.error_message = "Unknown error"
-            history.save()
+    msg = PushMessageBase.from_json(message)
+    if msg.uses_server_side_topics():
+        result = send_topics(msg)
+        if callback := getattr(settings, "FCM_SEND_COMPLETE_TASK", None):
+            signature(callback).delay(dict(result, message_id=msg.uuid))
+        return result
+
+    shard_size = getattr(settings, "FCM_SHARD_SIZE", None)
+    if shard_size and not send_message.request.called_directly:
+        shards = msg.get_shards(shard_size)
+        if len(shards) > 1:
+            return dispatch_shards(message, msg.uuid, shards)
+
+    result = send_devices(msg)
+    if callback := getattr(settings, "FCM_SEND_COMPLETE_TASK", None):
+        signature(callback).delay(dict(result, message_id=msg.uuid))
+    return result
+
+
+@shared_task(autoretry_for=FCM_RETRY_EXCEPTIONS, retry_backoff=True)
+def send_message_shard(message: str, first_pk: int, last_pk: int) -> dict[str, int]:
+    """Send a serialized message to the addressed devices within a primary key range"""
+    from .message import PushMessageBase
+
+    return send_devices(PushMessageBase.from_json(message), pk_range=(first_pk, last_pk))
+
+
+@shared_task
+def collect_shard_results(results: list[dict[str, int]], message_id: str) -> dict[str, Any]:
+    """Aggregate the results of all shards of a message"""
+    summary = Counter(sent=0, failed=0)
+    for result in results:
+        summary.update(result)
+    return dict(summary, message_id=message_id)
+
+
+@shared_task(autoretry_for=FCM_RETRY_EXCEPTIONS, retry_backoff=True)
+def sync_topic_subscriptions(topic: Optional[str] = None) -> dict[str, int]:
+    """Push the topic subscriptions of all devices to firebase
+
+    :param topic: Only sync the topic with this name, by default all topics are synced
+    :returns: Number of ``subscribed``, ``unsubscribed`` and ``failed`` tokens
+    """
+    topics = FCMTopic.objects.all()
+    if topic is not None:
+        topics = topics.filter(name=topic)
+
+    summary = Counter(subscribed=0, unsubscribed=0, failed=0)
+    for topic_obj in topics:
+        summary.update(sync_topic(topic_obj, app=firebase))
+    return dict(summary)
+
+
+@shared_task(autoretry_for=FCM_RETRY_EXCEPTIONS, retry_backoff=True)
+def sync_subscription_changes() -> dict[str, int]:
+    """Push the recorded topic subscription changes to firebase, run this periodically"""
+    return push_changes(app=firebase)
+
+
+@shared_task
+def write_history(entries: str) -> int:
+    """Create history entries that were serialized by ``WriteBehindHistoryWriter``
+
+    :param entries: History entries serialized with the django ``json`` serializer
+    :returns: Number of created entries
+    """
+    history = [entry.object for entry in serializers.deserialize("json", entries)]
+
+    # Devices may have been removed since the message was sent
+    device_ids = {entry.device_id for entry in history if entry.device_id is not None}
+    existing = set(FCMDevice.objects.filter(pk__in=device_ids).values_list("pk", flat=True))
+    for entry in history:
+        if entry.device_id not in existing:
+            entry.device_id = None
+
+    # Keep the time of sending, ``bulk_create`` would apply ``auto_now_add``
+    return raw_bulk_create(history)
+
+
+@shared_task
+def dispatch_campaigns() -> int:
+    """Start due campaigns and release their shards within the rate limits, run this periodically
+
+    :returns: Number of released shards
+    """
+    from .campaigns import dispatch_due
+
+    return dispatch_due()
+
+
+@shared_task
+def record_campaign_progress(result: dict[str, int], campaign_id: int):
+    """Count the result of a shard of a campaign, linked to the shard tasks by ``dispatch_campaigns``"""
+    from .campaigns import record_progress
+
+    record_progress(campaign_id, result)
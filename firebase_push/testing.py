@@ -0,0 +1,130 @@
+import asyncio
+import json
+import random
+import threading
+from typing import Any, Optional
+
+
+class FakeFCMServer:
+    """Local stand-in for the FCM HTTP v1 send endpoint
+
+    Runs a small asyncio HTTP/1.1 server on a background thread that accepts
+    ``messages:send`` requests like firebase does. Point ``FCM_ENDPOINT_URL``
+    to ``server.url`` and use the ``async`` or ``threads`` send engine to
+    send to it.
+
+    - ``latency``: seconds to wait before answering a request
+    - ``error_rate``: probability (0-1) of answering with an internal error
+    - ``unregistered``: tokens that are answered with an ``UNREGISTERED`` error
+
+    Received messages are recorded in ``messages``.
+
+    Usage::
+
+        with FakeFCMServer(latency=0.05) as server:
+            with override_settings(FCM_ENDPOINT_URL=server.url, FCM_SEND_ENGINE="async"):
+                message.send(sync=True)
+            print(len(server.messages))
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        error_rate: float = 0,
+        unregistered: Optional[set[str]] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unregistered = unregistered or set()
+        self.messages: list[dict[str, Any]] = []
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1/projects/fake/messages:send"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, self.host, self.port, backlog=1024)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def respond(self, payload: dict[str, Any]) -> tuple[int, dict[str, Any]]:
+        """Build the status code and body of the answer to a send request"""
+        message = payload.get("message", {})
+        token = message.get("token")
+        if token in self.unregistered:
+            return 404, {
+                "error": {
+                    "code": 404,
+                    "message": "Requested entity was not found.",
+                    "status": "NOT_FOUND",
+                    "details": [
+                        {
+                            "@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+                            "errorCode": "UNREGISTERED",
+                        }
+                    ],
+                }
+            }
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {"error": {"code": 500, "message": "Internal error encountered.", "status": "INTERNAL"}}
+
+        self.messages.append(message)
+        return 200, {"name": f"projects/fake/messages/{len(self.messages)}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                length = 0
+                for line in head.decode("latin-1").split("\r\n")[1:]:
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value.strip())
+                try:
+                    payload = json.loads(await reader.readexactly(length)) if length else {}
+                except ValueError:
+                    payload = {}
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                status, body = self.respond(payload)
+                data = json.dumps(body).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json; charset=UTF-8\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        finally:
+            writer.close()
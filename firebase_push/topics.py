@@ -0,0 +1,95 @@
+"""
+Resolves topic names without querying the database every time
+
+Enabled with ``FCM_TOPIC_CACHE_TIMEOUT``. Topics that have been looked up are
+kept in memory of the process for that many seconds. Saving or deleting a
+topic bumps a version in the django cache (see ``FCM_CACHE``), which makes all
+processes drop their topics on their next lookup.
+
+Topics that do not exist are not remembered, so creating a topic is seen
+immediately. Changes with ``QuerySet.update()`` or raw SQL have to call
+``invalidate()``.
+"""
+
+import time
+from typing import Iterable, Optional
+
+from django.conf import settings
+
+from firebase_push.models import FCMTopic
+from firebase_push.utils import cache_incr, get_cache
+
+
+VERSION_KEY = "firebase_push:topics:version"
+
+
+class TopicRegistry:
+    """Process local mapping of topic names to topics"""
+
+    def __init__(self) -> None:
+        self._topics: dict[str, tuple[FCMTopic, float]] = {}
+        self._version: Optional[int] = None
+
+    def get_topics(self, names: Iterable[str]) -> dict[str, FCMTopic]:
+        """Resolve topic names, unknown names are fetched with one query
+
+        :returns: Topics by name, names of topics that do not exist are missing
+        """
+        names = list(dict.fromkeys(names))
+        timeout = getattr(settings, "FCM_TOPIC_CACHE_TIMEOUT", None)
+        if timeout is None:
+            return FCMTopic.objects.in_bulk(names, field_name="name") if names else {}
+
+        version = get_cache().get(VERSION_KEY, 0)
+        if version != self._version:
+            self._topics = {}
+            self._version = version
+
+        now = time.monotonic()
+        result: dict[str, FCMTopic] = {}
+        for name in names:
+            entry = self._topics.get(name)
+            if entry is not None and entry[1] > now:
+                result[name] = entry[0]
+        missing = [name for name in names if name not in result]
+        if missing:
+            loaded = FCMTopic.objects.in_bulk(missing, field_name="name")
+            self._topics.update((name, (topic, now + timeout)) for name, topic in loaded.items())
+            result.update(loaded)
+        return result
+
+    def clear(self):
+        """Forget the topics of this process"""
+        self._topics = {}
+        self._version = None
+
+
+registry = TopicRegistry()
+
+
+def get_topics(names: Iterable[str]) -> dict[str, FCMTopic]:
+    """Resolve topic names, see ``TopicRegistry.get_topics()``"""
+    return registry.get_topics(names)
+
+
+def ensure_topics(names: Iterable[str]) -> dict[str, FCMTopic]:
+    """Resolve topic names, topics that do not exist yet are created
+
+    Concurrent calls creating the same topic are safe, conflicting inserts are
+    ignored and the topics are fetched afterwards.
+
+    :returns: Topics by name
+    """
+    names = list(dict.fromkeys(names))
+    topics = registry.get_topics(names)
+    missing = [name for name in names if name not in topics]
+    if missing:
+        FCMTopic.objects.bulk_create([FCMTopic(name=name) for name in missing], ignore_conflicts=True)
+        topics.update(registry.get_topics(missing))
+    return topics
+
+
+def invalidate():
+    """Make all processes drop their remembered topics"""
+    cache_incr(VERSION_KEY)
+    registry.clear()
@@ -1,6 +1,12 @@
+from typing import Optional
+
 from django.apps import apps as django_apps
 from django.conf import settings
+from django.core.cache import BaseCache, caches
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.db.models import Model, QuerySet
+from django.db.models.deletion import Collector
 
 
 def get_device_model():
@@ -29,3 +35,59 @@ def get_history_model():
         raise ImproperlyConfigured(
             "FCM_PUSH_HISTORY_MODEL refers to model '%s' that has not been installed" % settings.FCM_PUSH_HISTORY_MODEL
         )
+
+
+def fast_delete(queryset: QuerySet) -> int:
+    """
+    Delete the rows of a queryset, with a single ``DELETE`` statement if possible.
+
+    Django collects related objects in python before deleting, this is skipped
+    when nothing cascades from the model and no delete signals are connected.
+    """
+    if Collector(using=queryset.db, origin=queryset).can_fast_delete(queryset):
+        return queryset._raw_delete(queryset.db)
+    _, deleted = queryset.delete()
+    return deleted.get(queryset.model._meta.label, 0)
+
+
+def raw_bulk_create(objs: list[Model]) -> int:
+    """
+    Insert model instances like ``bulk_create`` but store their values as they are.
+
+    ``bulk_create`` calls ``pre_save()``, which overwrites the values of
+    ``auto_now`` and ``auto_now_add`` fields, this inserts the raw values like
+    loading fixtures does. Primary keys are not set on the instances.
+    """
+    if not objs:
+        return 0
+    model = type(objs[0])
+    using = router.db_for_write(model)
+    fields = [field for field in model._meta.concrete_fields if field is not model._meta.auto_field]
+    batch_size = connections[using].ops.bulk_batch_size(fields, objs) or len(objs)
+    for offset in range(0, len(objs), batch_size):
+        model._base_manager._insert(objs[offset : offset + batch_size], fields=fields, raw=True, using=using)
+    return len(objs)
+
+
+def get_cache() -> BaseCache:
+    """
+    Return the django cache configured with ``FCM_CACHE``.
+    """
+    return caches[getattr(settings, "FCM_CACHE", "default")]
+
+
+def cache_incr(key: str, delta: int = 1, timeout: Optional[int] = None) -> int:
+    """
+    Atomically increment a counter in the ``FCM_CACHE`` cache, missing counters start at ``0``.
+
+    :param timeout: Timeout of the counter when it is created, ``None`` never expires
+    :returns: The incremented value
+    """
+    cache = get_cache()
+    cache.add(key, 0, timeout=timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, delta, timeout=timeout)
+        return delta
@@ -1,9 +1,16 @@
 from django.conf import settings
+from django.db.models import prefetch_related_objects
 from django.shortcuts import get_object_or_404
 from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
 from firebase_push.serializers import FCMDeviceSerializer
+from firebase_push.serializers.devices import register_devices
+from firebase_push.topics import get_topics
 from firebase_push.utils import get_device_model
 
 
@@ -49,3 +56,61 @@ class DeviceRegistrationViewSet(ModelViewSet):
         self.check_object_permissions(self.request, obj)
 
         return obj
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        """Register a list of devices at once
+
+        Every item is validated like a single registration. Valid items are
+        registered with a constant number of queries, the response contains a
+        result for each item in the order of the request: either ``status``
+        (``created`` or ``updated``) and the ``device`` or the ``errors``.
+        """
+        limit = getattr(settings, "FCM_BULK_REGISTRATION_LIMIT", 1000)
+        if not isinstance(request.data, list):
+            raise ValidationError(_("Expected a list of registrations."))
+        if len(request.data) > limit:
+            raise ValidationError(_("Ensure this list has no more than {limit} registrations.").format(limit=limit))
+
+        # Resolve the topics of all items with one query
+        names = {
+            name
+            for item in request.data
+            if isinstance(item, dict) and isinstance(item.get("topics"), list)
+            for name in item["topics"]
+            if isinstance(name, str)
+        }
+        context = self.get_serializer_context()
+        context["topics"] = get_topics(names)
+
+        results: list[dict] = [{} for _item in request.data]
+        valid: list[int] = []
+        registrations = []
+        seen: set[str] = set()
+        for index, item in enumerate(request.data):
+            serializer = FCMDeviceSerializer(data=item, context=context)
+            if not serializer.is_valid():
+                results[index] = {"errors": serializer.errors}
+                continue
+            data = dict(serializer.validated_data)
+            registration_id = data.pop("registration_id")
+            if registration_id in seen:
+                results[index] = {"errors": {"registration_id": [_("Duplicate registration in request.")]}}
+                continue
+            seen.add(registration_id)
+            valid.append(index)
+            registrations.append((registration_id, data))
+
+        registered = register_devices(get_user(request), registrations) if registrations else []
+
+        # Devices that did not send topics keep their current topics
+        prefetch_related_objects(
+            [device for device, _created in registered if getattr(device, "_registered_topics", None) is None],
+            "topics",
+        )
+        for index, (device, created) in zip(valid, registered):
+            results[index] = {
+                "status": "created" if created else "updated",
+                "device": FCMDeviceSerializer(device, context=context).data,
+            }
+        return Response(results)